@@ -0,0 +1,506 @@
+"""各処理段階の所要時間・ピークメモリを計測するベンチマーク
+
+合成した songdata.db と、ローカルの HTTP サーバから配信する合成難易度表を使うので、
+ネットワークや実際の beatoraja 環境がなくても実行できる。
+
+    python ./benchmark.py --rows 10000 100000 --json bench.json
+    python ./benchmark.py --rows 100000 --baseline bench.json
+    python ./benchmark.py --startup-only --startup-budget 0.5
+    python ./benchmark.py --check-only
+
+--baseline を指定すると、以前の結果より遅くなった段階があれば終了コード 1 で終了する。
+起動時間（新しいプロセスでの import main と、ウィンドウの最初の描画まで）が --startup-budget を超えた場合や、
+起動時に pandas などの重いモジュールを読み込んでいた場合も終了コード 1 で終了する。
+計測の前に、「たぶん所持」の判定と、ダウンロード（受信の途中で切れた場合の再開、エラーのステータス）の
+動作確認も行い、期待どおりでなければ終了コード 1 で終了する
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import threading
+import tracemalloc
+import http.server
+from hashlib import md5, sha256
+from functools import partial
+
+import pandas as pd
+import requests
+
+import songdata
+import bmstable
+import downloader
+import songindex
+import songsearch
+import fuzzymatch
+
+
+# 合成データの割合
+DUPLICATE_RATIO = 0.05      # 別フォルダに同じ譜面を重複所持している行
+SHA256_ONLY_RATIO = 0.05    # md5 が空で sha256 のみの行
+TABLE_OWNED_MD5_RATIO = 0.6
+TABLE_OWNED_SHA256_RATIO = 0.1
+
+LEVELS = [str(i) for i in range(1, 13)] + ['?']
+
+# 起動（import main からウィンドウの最初の描画まで）にかけてよい時間（秒）
+STARTUP_BUDGET_SECONDS = 1.0
+
+# 起動時には読み込まないモジュール（songdata.db の読み込みなど、初めて使うときに読み込む）
+STARTUP_DEFERRED_MODULES = ['numpy', 'pandas', 'requests', 'songdata', 'bmstable']
+
+# 新しいプロセスで実行し、起動の各段階までの時間を JSON で出力するスクリプト
+STARTUP_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import tkinter as tk
+import main
+result = {'import main': time.perf_counter() - start}
+try:
+    window = main.MainWindow([{'name': 'bench', 'url': ''}])
+    window.update()
+    result['first paint'] = time.perf_counter() - start
+    window.destroy()
+except tk.TclError:
+    pass
+result['loaded'] = [m for m in json.loads(sys.argv[1]) if m in sys.modules]
+print(json.dumps(result))
+"""
+
+
+def generate_songdata_db(db_path, rows, seed=0):
+    """beatoraja の song テーブルを模した songdata.db を作る"""
+    rng = random.Random(seed)
+    connection = sqlite3.connect(db_path)
+    connection.execute('CREATE TABLE song (md5 TEXT, sha256 TEXT, title TEXT, subtitle TEXT, genre TEXT, '
+                       'artist TEXT, subartist TEXT, path TEXT PRIMARY KEY, folder TEXT, parent TEXT, level INTEGER)')
+
+    artists = [f'Artist {i}' for i in range(max(1, rows // 20))]
+    records = []
+    for i in range(rows):
+        if records and rng.random() < DUPLICATE_RATIO:
+            # 同じ譜面を別フォルダに所持
+            dup = list(rng.choice(records))
+            dup[7] = f'E:/BMS/dup{i}/{os.path.basename(dup[7])}'
+            dup[8] = f'dup{i}'
+            records.append(tuple(dup))
+            continue
+
+        song_id = i // 4
+        chart_md5 = '' if rng.random() < SHA256_ONLY_RATIO else md5(str(i).encode()).hexdigest()
+        records.append((
+            chart_md5,
+            sha256(str(i).encode()).hexdigest(),
+            f'Song {song_id} {rng.choice(["Remix", "Original", "Edit", "ソング"])}',
+            rng.choice(['[NORMAL]', '[HYPER]', '[ANOTHER]', '']),
+            'Genre',
+            rng.choice(artists),
+            '',
+            f'E:/BMS/folder{song_id}/chart{i}.bms',
+            f'folder{song_id}',
+            'BMS',
+            rng.randint(1, 12),
+        ))
+
+    connection.executemany('INSERT INTO song VALUES (?,?,?,?,?,?,?,?,?,?,?)', records)
+    connection.commit()
+    connection.close()
+
+
+def generate_table_fixture(www_dir, name, db_path, table_rows, seed=0):
+    """難易度表の HTML・ヘッダ JSON・データ JSON を www_dir に作る。HTML のファイル名を返す"""
+    rng = random.Random(seed)
+    connection = sqlite3.connect(db_path)
+    owned = connection.execute('SELECT md5, sha256, title, artist FROM song ORDER BY RANDOM() LIMIT ?', (table_rows,)).fetchall()
+    connection.close()
+
+    data = []
+    for i in range(table_rows):
+        r = rng.random()
+        chart = {'level': rng.choice(LEVELS), 'url': f'http://example.com/{i}', 'url_diff': '', 'comment': ''}
+        if r < TABLE_OWNED_MD5_RATIO and owned[i % len(owned)][0]:
+            chart.update(md5=owned[i % len(owned)][0], title=owned[i % len(owned)][2], artist=owned[i % len(owned)][3])
+        elif r < TABLE_OWNED_MD5_RATIO + TABLE_OWNED_SHA256_RATIO:
+            chart.update(md5='', sha256=owned[i % len(owned)][1], title=owned[i % len(owned)][2], artist=owned[i % len(owned)][3])
+        else:
+            chart.update(md5=md5(f'missing{i}'.encode()).hexdigest(), title=f'Missing {i}', artist='Someone')
+        data.append(chart)
+
+    with open(os.path.join(www_dir, f'{name}.html'), 'wt', encoding='utf-8') as f:
+        f.write(f'<html><head><meta name="bmstable" content="{name}_header.json"></head><body></body></html>')
+    with open(os.path.join(www_dir, f'{name}_header.json'), 'wt', encoding='utf-8') as f:
+        json.dump({'name': name, 'symbol': '★', 'data_url': f'{name}_data.json', 'level_order': LEVELS}, f)
+    with open(os.path.join(www_dir, f'{name}_data.json'), 'wt', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+
+    return f'{name}.html'
+
+
+class LocalHttpServer():
+    """www_dir を配信するローカルの HTTP サーバ（別スレッドで動かす）"""
+
+    def __init__(self, www_dir, handler_class=None):
+        handler = partial(handler_class or _QuietHandler, directory=www_dir)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, path):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/{path}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _FaultyHandler(_QuietHandler):
+    """パスの先頭で指定した障害を起こしながら www_dir を配信する（ダウンロードの動作確認用）
+
+    - /drop/{ファイル}: パスごとに一度だけ、本文の途中で接続を切る（Range には対応しない）
+    - /drop-range/{ファイル}: 同上。Range（If-Range）に対応する
+    - /status-{コード}/{ファイル}: 常にそのステータスを返す
+    """
+    protocol_version = 'HTTP/1.1'
+
+    # 接続を切ったパスと、Range に応じて 206 を返したパス（check_downloader で空にする）
+    dropped_paths = set()
+    ranged_paths = set()
+
+    def do_GET(self):
+        fault, _, path = self.path.lstrip('/').partition('/')
+        if fault.startswith('status-'):
+            self.send_error(int(fault[len('status-'):]))
+            return
+
+        with open(self.translate_path(f'/{path}'), 'rb') as f:
+            body = f.read()
+        etag = f'"{md5(body).hexdigest()}"'
+        accept_ranges = fault == 'drop-range'
+
+        start = 0
+        range_header = self.headers.get('Range', '')
+        if accept_ranges and range_header.startswith('bytes=') and self.headers.get('If-Range') == etag:
+            start = int(range_header[len('bytes='):].split('-')[0])
+            self.ranged_paths.add(self.path)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        if fault in ('drop', 'drop-range') and not self.path in self.dropped_paths:
+            self.dropped_paths.add(self.path)
+            self.wfile.write(body[start:start + (len(body) - start) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        self.wfile.write(body[start:])
+
+
+def check_title_matching():
+    """「たぶん所持」の判定（fuzzymatch.TitleMatcher）が期待どおりか確かめ、問題の内容のリストを返す"""
+    # 先頭が同じタイトルが MAX_PREFIX_CANDIDATES より多くあっても、長さの近いタイトルは候補に残る
+    similar_titles = [f'Same Prefix Long Title No.{i}' for i in range(fuzzymatch.MAX_PREFIX_CANDIDATES + 10)]
+    songs = ([('Song [NORMAL]', '', 'Composer'), ('Song [HYPER]', '', 'Composer'), ('Other Song', '[ANOTHER]', 'Someone')]
+             + [(title, '', 'Someone') for title in similar_titles]
+             + [('Same Prefix', '', 'Composer')])
+    df_songdata = pd.DataFrame(songs, columns=['title', 'subtitle', 'artist']).astype('category')
+    matcher = fuzzymatch.TitleMatcher(df_songdata)
+
+    # (タイトル, アーティスト, 期待する行位置（「たぶん所持」としないなら None）)
+    cases = [
+        ('Song [HYPER]', 'Composer', 1),
+        ('ＳＯＮＧ　［ｈｙｐｅｒ］', 'ＣＯＭＰＯＳＥＲ', 1),
+        ('Other Song [ANOTHER]', 'Someone', 2),
+        ('Same Prefix!', 'Composer', len(songs) - 1),
+        ('Same Prefixes', 'Composer', len(songs) - 1),
+        ('Song [ANOTHER]', 'Composer', None),
+        ('Song [★24 sabun by someone]', 'Composer', None),
+        ('Other Song [HYPER]', 'Someone', None),
+    ]
+    rows, scores = matcher.match([title for title, _, _ in cases], [artist for _, artist, _ in cases])
+
+    problems = []
+    for (title, artist, expected), row, score in zip(cases, rows, scores):
+        actual = row if score >= fuzzymatch.PROBABLY_OWNED_SCORE else None
+        if actual != expected:
+            problems.append(f'たぶん所持の判定が期待と異なります: {title} / {artist}: {actual}（類似度 {score:.2f}）, 期待 {expected}')
+    return problems
+
+
+def check_downloader(work_dir):
+    """ローカルの HTTP サーバで障害を起こし、ダウンロードが期待どおりか確かめ、問題の内容のリストを返す
+
+    - 本文の途中で接続が切れても、再開して同じデータを受信できる（Range に対応していてもいなくても）
+    - 最終的なレスポンスが 4xx, 5xx なら requests.HTTPError を送出する
+    """
+    www_dir = os.path.join(work_dir, 'www_faulty')
+    os.makedirs(www_dir, exist_ok=True)
+    columns = ['level', 'title', 'md5']
+    records = [{'level': LEVELS[i % len(LEVELS)], 'title': f'曲 {i}', 'md5': md5(str(i).encode()).hexdigest()} for i in range(20000)]
+    with open(os.path.join(www_dir, 'data.json'), 'wt', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False)
+    expected, _ = bmstable._collect_columns(records, columns)
+
+    problems = []
+    _FaultyHandler.dropped_paths.clear()
+    _FaultyHandler.ranged_paths.clear()
+    backoff_seconds = downloader.HTTP_RETRY_BACKOFF_SECONDS
+    downloader.HTTP_RETRY_BACKOFF_SECONDS = 0.01
+    try:
+        with LocalHttpServer(www_dir, _FaultyHandler) as server:
+            for fault in ['drop', 'drop-range']:
+                before = downloader.stats()
+                try:
+                    data, _ = bmstable._get_json_columns(server.url(f'{fault}/data.json'), columns)
+                except Exception as e:
+                    problems.append(f'ダウンロード（{fault}）に失敗しました: {e!r}')
+                    continue
+                if data != expected:
+                    problems.append(f'ダウンロード（{fault}）で受信したデータが異なります')
+                if downloader.stats_since(before).resumed == 0:
+                    problems.append(f'ダウンロード（{fault}）で受信を再開していません')
+                if fault == 'drop-range' and not f'/{fault}/data.json' in _FaultyHandler.ranged_paths:
+                    problems.append(f'ダウンロード（{fault}）で Range による再開をしていません')
+
+            for status in [404, 503]:
+                url = server.url(f'status-{status}/data.json')
+                for name, func in [('get', lambda: downloader.get(url)),
+                                   ('_get_json_columns', lambda: bmstable._get_json_columns(url, columns))]:
+                    try:
+                        func()
+                        problems.append(f'HTTP {status} で {name} が例外を送出しません')
+                    except requests.HTTPError as e:
+                        if e.response is None or e.response.status_code != status:
+                            problems.append(f'HTTP {status} で {name} が送出した HTTPError のステータスが異なります: {e}')
+                    except Exception as e:
+                        problems.append(f'HTTP {status} で {name} が HTTPError 以外を送出しました: {e!r}')
+    finally:
+        downloader.HTTP_RETRY_BACKOFF_SECONDS = backoff_seconds
+
+    return problems
+
+
+def measure(func, setup=None, repeat=3):
+    """func の所要時間（repeat 回の最小値, 秒）と、ピークメモリ（バイト）を計測する
+
+    所要時間は tracemalloc を止めた状態で計り、ピークメモリは別に一度だけ実行して計る
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak
+
+
+def _make_sheet_window():
+    """_update_sheet の計測用に MainWindow を作る。表示できない環境では None を返す"""
+    import tkinter as tk
+    import main
+    try:
+        window = main.MainWindow([{'name': 'bench', 'url': ''}])
+    except tk.TclError:
+        return None
+    window.withdraw()
+    return window
+
+
+def run_benchmark(rows, table_rows, repeat, work_dir):
+    """songdata の行数 rows について各段階を計測し、{段階名: (秒, バイト)} を返す"""
+    db_path = os.path.join(work_dir, f'songdata_{rows}.db')
+    www_dir = os.path.join(work_dir, 'www')
+    os.makedirs(www_dir, exist_ok=True)
+
+    if not os.path.isfile(db_path):
+        generate_songdata_db(db_path, rows)
+    html_name = generate_table_fixture(www_dir, f'table_{rows}', db_path, table_rows)
+
+    results = {}
+    clear_songdata_cache = lambda: shutil.rmtree(songdata.SONGDATA_CACHE_DIR, ignore_errors=True)
+
+    results['read_songdata (cold)'] = measure(lambda: songdata.read_songdata(db_path), setup=clear_songdata_cache, repeat=repeat)
+    results['read_songdata (cached)'] = measure(lambda: songdata.read_songdata(db_path), repeat=repeat)
+    df_songdata = songdata.read_songdata(db_path)
+
+    results['SongIndex'] = measure(lambda: songindex.SongIndex(df_songdata), repeat=repeat)
+    results['SongSearchIndex'] = measure(lambda: songsearch.SongSearchIndex(df_songdata), repeat=repeat)
+    results['TitleMatcher'] = measure(lambda: fuzzymatch.TitleMatcher(df_songdata), repeat=repeat)
+
+    with LocalHttpServer(www_dir) as server:
+        table = bmstable.BmsTable([{'name': 'bench', 'url': server.url(html_name)}], df_songdata)
+        results['_download_table'] = measure(lambda: table._download_table(0), repeat=repeat)
+        table_header, df_table_orig, cache_meta = table._download_table(0)
+
+    table._save_table_cache(0, table_header, df_table_orig, cache_meta)
+    results['_load_table_cache'] = measure(lambda: table._load_table_cache(0), repeat=repeat)
+    results['ownership_summary'] = measure(table.ownership_summary, repeat=repeat)
+    results['library_analysis'] = measure(table.library_analysis, repeat=repeat)
+    results['_merge_table_and_songdata'] = measure(lambda: table._merge_table_and_songdata(df_table_orig, table.song_index), repeat=repeat)
+    title_matcher = fuzzymatch.TitleMatcher(df_songdata)
+    df_table = table._merge_table_and_songdata(df_table_orig, table.song_index)
+    results['find_probably_owned'] = measure(lambda: fuzzymatch.find_probably_owned(title_matcher, df_table), repeat=repeat)
+    sql_song_index = songindex.SqlSongIndex(songdata.open_songdata_db(db_path))
+    results['SqlSongIndex.resolve'] = measure(lambda: sql_song_index.resolve(df_table_orig['md5'], df_table_orig['sha256']), repeat=repeat)
+    table.load(0)
+
+    results['make_table_view'] = measure(lambda: bmstable.make_table_view(table.get_header(), table.get_table()), repeat=repeat)
+    results['make_row_details'] = measure(lambda: bmstable.make_row_details(table.get_table_view()), repeat=repeat)
+    results['fetch (memory)'] = measure(lambda: table.fetch(0), repeat=repeat)
+
+    window = _make_sheet_window()
+    if window:
+        window.set_table(table)
+        results['_update_sheet'] = measure(lambda: window._update_sheet(show_only_notfound=False), repeat=repeat)
+        window.destroy()
+
+    return results
+
+
+def measure_startup(repeat):
+    """新しいプロセスで起動の各段階までの時間（repeat 回の最小値, 秒）を計測する。
+
+    ({段階名: (秒, 0)}, 起動時に読み込まれていた STARTUP_DEFERRED_MODULES) を返す。
+    表示できない環境では、ウィンドウの描画は計測しない
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    times = {}
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, json.dumps(STARTUP_DEFERRED_MODULES)],
+                                cwd=script_dir, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        loaded = result.pop('loaded')
+        for stage, seconds in result.items():
+            times[stage] = min(times.get(stage, seconds), seconds)
+
+    return {stage: (seconds, 0) for stage, seconds in times.items()}, loaded
+
+
+def check_startup_budget(stages, loaded, budget):
+    """起動時間が budget を超えているか、読み込みを遅らせるべきモジュールを読み込んでいれば、その内容のリストを返す"""
+    problems = []
+    seconds = stages.get('first paint', stages['import main'])[0]
+    if seconds > budget:
+        problems.append(f'起動時間が上限を超えています: {seconds * 1000:.1f} ms > {budget * 1000:.1f} ms')
+    if loaded:
+        problems.append(f'起動時に読み込まれているモジュール: {", ".join(loaded)}')
+    return problems
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """baseline より tolerance 倍以上遅くなった段階の一覧を返す"""
+    regressions = []
+    for rows, stages in results.items():
+        for stage, (seconds, _) in stages.items():
+            base = baseline.get(rows, {}).get(stage)
+            if base and seconds > base[0] * tolerance:
+                regressions.append((rows, stage, base[0], seconds))
+    return regressions
+
+
+def print_results(results):
+    for rows, stages in results.items():
+        print('## 起動' if rows == 'startup' else f'## songdata {rows} 行')
+        for stage, (seconds, peak) in stages.items():
+            print(f'{stage:<30} {seconds * 1000:10.1f} ms {peak / 1024 / 1024:10.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000], help='songdata の行数（複数指定可）')
+    parser.add_argument('--table-rows', type=int, default=2000, help='難易度表の譜面数')
+    parser.add_argument('--repeat', type=int, default=3, help='各段階の実行回数（最小値を採用）')
+    parser.add_argument('--json', metavar='PATH', help='結果を JSON で保存する')
+    parser.add_argument('--baseline', metavar='PATH', help='比較対象の結果（--json で保存したもの）')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='baseline の何倍まで遅くなってよいか')
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET_SECONDS, help='起動時間の上限（秒）')
+    parser.add_argument('--startup-only', action='store_true', help='起動時間だけを計測する')
+    parser.add_argument('--check-only', action='store_true', help='動作確認だけを行い、計測はしない')
+    args = parser.parse_args()
+
+    # キャッシュ（cache/）は作業フォルダに作る
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    json_path = os.path.abspath(args.json) if args.json else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    problems = check_title_matching()
+    with tempfile.TemporaryDirectory() as work_dir:
+        problems += check_downloader(work_dir)
+    for problem in problems:
+        print(problem)
+    if args.check_only:
+        sys.exit(1 if problems else 0)
+
+    results = {}
+    results['startup'], startup_loaded = measure_startup(args.repeat)
+
+    if not args.startup_only:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            try:
+                for rows in args.rows:
+                    results[str(rows)] = run_benchmark(rows, args.table_rows, args.repeat, work_dir)
+            finally:
+                os.chdir(script_dir)
+
+    print_results(results)
+
+    failed = bool(problems)
+    for problem in check_startup_budget(results['startup'], startup_loaded, args.startup_budget):
+        print(problem)
+        failed = True
+
+    if json_path:
+        with open(json_path, 'wt', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        for rows, stage, base, seconds in regressions:
+            print(f'遅くなった段階: songdata {rows} 行 {stage}: {base * 1000:.1f} ms -> {seconds * 1000:.1f} ms')
+        if regressions:
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,72 @@
 import os
+import re
+import sys
 import json
+import time
+import codecs
+import itertools
+import threading
 import numpy as np
 import pandas as pd
 import requests
 from html.parser import HTMLParser
 from urllib.parse import urljoin
 from hashlib import md5
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import colcache
+import downloader
+import fuzzymatch
+import instrument
+import library
+import ownership
+from songindex import SongIndex
+from lrucache import SizedLruCache
+
+
+# 難易度表の読み込み結果
+# - table_header: 難易度表ヘッダ
+# - df_table_orig: 難易度表のデータ
+# - df_table: df_table_orig と songdata をマージしたもの
+# - df_table_view: df_table を表示用に並び替えたもの（make_table_view）
+# - songdata_version: マージに使った songdata の版（BmsTable.songdata_version）
+# - row_details: df_table_view の各行の RowDetail のリスト（make_row_details）
+LoadedTable = namedtuple('LoadedTable', ['table_index', 'table_header', 'df_table_orig', 'df_table', 'df_table_view', 'songdata_version', 'row_details'])
+
+# シートで行を選択したときに表示する譜面の情報（表示する文字列そのもの）
+# - url_diff_text, url_pack_text: 差分・パッケージの URL と名前
+# - search_text: 検索欄に入れる文字列（タイトル末尾の [差分名] を除いたもの）
+# - probable_text, probable_dir: 「たぶん所持」の曲の格納パスと類似度、そのフォルダ（なければ ''）
+RowDetail = namedtuple('RowDetail', ['title', 'ir_url', 'url', 'url_diff', 'url_diff_text', 'url_pack', 'url_pack_text', 'search_text',
+                                     'probable_text', 'probable_dir'])
+
+LR2IR_RANKING_URL = 'http://www.dream-pro.info/~lavalse/LR2IR/search.cgi?mode=ranking&bmsmd5='
+
+# 難易度表データを受信・解析する単位（バイト）
+JSON_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+_json_separator = re.compile(r'[ \t\n\r]*,[ \t\n\r]*')
+
+
+# ダウンロード中の中断も、読み込みの中断として扱う
+LoadCancelled = downloader.DownloadCancelled
+
+
+class _StreamDecodeError(Exception):
+    """指定された文字コード（指定がなければ UTF-8）で読めないレスポンス"""
+    pass
 
 
 class HtmlBmsTableParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.table_header_url = ''
+
     def handle_starttag(self, tag, attrs):
         if tag.lower() != 'meta': return
 
@@ -30,57 +88,606 @@ def _files_exist_all(files):
     return all(map(os.path.isfile, files))
 
 
-def _get_html_text(html_url):
-    res = requests.get(html_url)
+def _notify(progress, message):
+    instrument.event(message)
+    if progress:
+        progress(message)
+
+
+def _check_cancelled(cancel_event):
+    if cancel_event and cancel_event.is_set():
+        raise LoadCancelled()
+
+
+def _get_html_text(html_url, cancel_event=None):
+    res = downloader.get(html_url, cancel_event=cancel_event)
     return res.text
 
 
-def _get_json(json_url):
-    res = requests.get(json_url)
-    res.encoding = res.apparent_encoding
-    text = res.text
-    data = json.loads(text)
-    return data
+def _get_json(json_url, validators=None, cancel_event=None):
+    """JSON を取得する。
+
+    validators（前回取得時の {'url', 'etag', 'last_modified'}）を指定すると条件付きリクエストを行う。
+    (データ, 今回の validators) を返す。更新されていなければ（304）データは None となる
+    """
+    validators = _validators_for(json_url, validators)
+
+    res = downloader.get(json_url, _conditional_headers(validators), cancel_event)
+    if res.status_code == 304:
+        return None, validators
+
+    with instrument.span('parse_json', bytes=len(res.content)):
+        res.encoding = res.apparent_encoding
+        text = res.text
+        data = json.loads(text)
+
+    return data, _response_validators(json_url, res)
+
+
+def _get_json_columns(json_url, columns, validators=None, cancel_event=None):
+    """JSON の配列（難易度表データ）を受信しながら解析し、列ごとのリストにして返す。
+
+    columns に含まれるキーだけを {キー: 値のリスト} に取り出す（どの要素にもないキーは含めない。
+    一部の要素にないキーの値は NaN）。全体のテキストや要素の dict のリストは作らない。
+    サーバが文字コードを指定していればそれで、なければ UTF-8 として逐次デコードする。
+    その文字コードで読めない場合（指定が誤っている場合を含む）のみ、全体を受信して文字コードを推定する（_get_json と同じ処理）。
+    戻り値は _get_json と同様
+    """
+    validators = _validators_for(json_url, validators)
+
+    try:
+        with downloader.Download(json_url, _conditional_headers(validators), cancel_event) as download:
+            if download.status_code == 304:
+                return None, validators
+
+            res = download.response
+            def text_chunks():
+                decoder = codecs.getincrementaldecoder(_declared_encoding(res) or 'utf-8-sig')()
+                for chunk in download.chunks(JSON_STREAM_CHUNK_SIZE):
+                    yield _decode_chunk(decoder, chunk)
+                yield _decode_chunk(decoder, b'', final=True)
+
+            data, count = _collect_columns(_iter_json_array(text_chunks()), columns)
+            download.span.set(rows=count)
+            return data, _response_validators(json_url, res)
+
+    except _StreamDecodeError:
+        records, new_validators = _get_json(json_url, cancel_event=cancel_event)
+        data, _ = _collect_columns(records, columns)
+        return data, new_validators
+
+
+def _validators_for(url, validators):
+    return validators if validators and validators.get('url') == url else {}
+
+
+def _conditional_headers(validators):
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def _response_validators(url, res):
+    return {
+        'url': url,
+        'etag': res.headers.get('ETag'),
+        'last_modified': res.headers.get('Last-Modified'),
+    }
+
+
+def _declared_encoding(res):
+    """Content-Type で指定された文字コード（指定がない・不明な場合は None）"""
+    match = re.search(r'charset\s*=\s*["\']?([\w.:-]+)', res.headers.get('Content-Type', ''), re.IGNORECASE)
+    if not match:
+        return None
+
+    try:
+        encoding = codecs.lookup(match.group(1)).name
+    except LookupError:
+        return None
+
+    # サーバの既定値として付けられていることが多く、どんなバイト列でもデコードできてしまうので信用しない
+    if encoding in ('latin-1', 'iso8859-1', 'ascii', 'cp1252'):
+        return None
+    # BOM が付いていても読めるようにする
+    return 'utf-8-sig' if encoding == 'utf-8' else encoding
+
+
+def _decode_chunk(decoder, chunk, final=False):
+    # 文字コードの指定が誤っていることも多いので、読めなければ全体から推定し直す（_get_json_columns）
+    try:
+        return decoder.decode(chunk, final)
+    except UnicodeDecodeError:
+        raise _StreamDecodeError()
+
+
+def _iter_json_array(text_chunks):
+    """分割して届く JSON の配列のテキストから、要素を先頭から順に返す"""
+    buf = ''
+    pos = 0
+    state = 'open'  # open: '[' の前, first: 最初の要素の前, value: ',' の後, separator: 要素の後
+
+    while True:
+        pos = _json_whitespace.match(buf, pos).end()
+        if pos == len(buf):
+            chunk = next(text_chunks, None)
+            if chunk is None:
+                raise ValueError('難易度表データの JSON が途中で終わっています')
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+
+        c = buf[pos]
+        if state == 'open':
+            if c != '[':
+                raise ValueError('難易度表データが JSON の配列ではありません')
+            state, pos = 'first', pos + 1
+        elif state in ('first', 'separator') and c == ']':
+            return
+        elif state == 'separator':
+            if c != ',':
+                raise ValueError(f'難易度表データの JSON が不正です: {buf[pos:pos + 20]!r}')
+            state, pos = 'value', pos + 1
+        else:
+            # バッファ内で続いている要素はまとめて解析する
+            # 要素の末尾が届いていない（解析できない・数値などが途中で切れている可能性がある）なら続きを待つ
+            while state == 'value' or state == 'first':
+                try:
+                    value, end = _json_decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    break
+                if end == len(buf):
+                    break
+
+                yield value
+                separator = _json_separator.match(buf, end)
+                if separator is None:
+                    state, pos = 'separator', end
+                else:
+                    state, pos = 'value', separator.end()
+
+            if state == 'separator':
+                continue
+
+            chunk = next(text_chunks, None)
+            if chunk is not None:
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+
+            value, end = _json_decoder.raw_decode(buf, pos)
+            yield value
+            state, pos = 'separator', end
+
+
+def _collect_columns(records, columns, batch_size=1000):
+    """要素（dict）を順に読み、columns のキーの値を列ごとのリストにする。
+
+    ({キー: 値のリスト}, 要素数) を返す
+    """
+    data = {column: [] for column in columns}
+    present = set()
+    count = 0
+    records = iter(records)
+    while True:
+        batch = [record for record in itertools.islice(records, batch_size) if isinstance(record, dict)]
+        if not batch:
+            break
+
+        for column, values in data.items():
+            values.extend([record.get(column, np.nan) for record in batch])
+        present.update(*batch)
+        count += len(batch)
+
+    data = {column: values for column, values in data.items() if column in present}
+    return data, count
 
 
 class BmsTable():
     CACHE_ROOT_DIR = 'cache/'
     CACHE_FILE_LIST = [
         'table_header.json',
-        'df_table.pkl'
     ]
+    CACHE_TABLE_DATA_DIR = 'df_table/'
+    CACHE_META_FILE = 'cache_meta.json'
+
+    # 以前の形式（pickle）のキャッシュ
+    LEGACY_CACHE_TABLE_DATA_FILE = 'df_table.pkl'
+
+    # キャッシュの有効期間（時間）
+    # 難易度表リストの各要素に 'ttl_hours' があればそちらを使う
+    DEFAULT_CACHE_TTL_HOURS = 24
 
-    def __init__(self, table_list, df_songdata):
+    # すべての難易度表を更新するときの並列数
+    REFRESH_MAX_WORKERS = 8
+
+    # 難易度表データから読み込む列（表示・マージ・レポートで使うもの。それ以外の列は捨てる）
+    TABLE_DATA_COLUMNS = ['level', 'title', 'artist', 'md5', 'sha256', 'url', 'url_diff', 'name_diff', 'url_pack', 'name_pack', 'comment']
+
+    # マージ済みの難易度表をメモリ上に保持する量の上限（バイト）
+    LOADED_TABLES_MAX_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, table_list, df_songdata, song_index=None):
+        """song_index を渡せば、songdata の索引として df_songdata の SongIndex の代わりに使う
+        （songindex.SqlSongIndex を渡せば df_songdata は None でよい）
+        """
         self.table_list = table_list
         self.df_songdata = df_songdata
+        self.song_index = song_index or SongIndex(df_songdata)
+        self.songdata_version = 0
+
+        # タイトル・アーティストで「たぶん所持」を探すための索引（初めて使うときに作る）
+        # title_matcher_lock は、別スレッドで作った索引と songdata の版が食い違わないよう、songdata の入れ替えも守る
+        self.title_matcher = None
+        self.title_matcher_lock = threading.Lock()
         self.current_table_index = None
+        self.table_header = None
+        self.df_table_orig = None
+        self.df_table = None
+        self.df_table_view = None
+        self.row_details = None
+
+        # 読み込んだ難易度表（LoadedTable）。難易度表を切り替えて戻ったときに読み込み・マージを省く
+        self.loaded_tables = SizedLruCache(self.LOADED_TABLES_MAX_BYTES)
+
+        # 難易度表ごとのキャッシュの読み書き（ダウンロードして保存する間も含む）のロック（_table_cache_lock）
+        self._table_cache_locks = {}
+        self._table_cache_locks_lock = threading.Lock()
 
     def get_header(self):
         return self.table_header
     
     def get_table(self):
         return self.df_table
+
+    def get_table_view(self):
+        return self.df_table_view
+
+    def get_row_details(self):
+        return self.row_details
     
     def current_index(self):
         return self.current_table_index
 
+    def needs_update(self, table_index):
+        """難易度表のキャッシュがないか、有効期間が過ぎているか"""
+        return not (self._table_cache_exists(table_index) and self._table_cache_fresh(table_index))
+
     def load(self, table_index):
-        if not self._table_cache_exists(table_index):
-            print('キャッシュが存在しないので難易度表をダウンロード')
-            self._download_table(table_index)
-            self._save_table_cache(table_index)
-        else:
-            print('キャッシュから難易度表を読み込み')
-            self._load_table_cache(table_index)
+        self.set_loaded(self.fetch(table_index))
+
+    def fetch(self, table_index, progress=None, cancel_event=None, offline=False):
+        """難易度表を読み込み、songdata とマージした結果（LoadedTable）を返す。
+
+        インスタンスの状態は変更しないので、別スレッドから呼び出せる。
+        progress には進捗メッセージを受け取る関数を、
+        cancel_event には threading.Event を指定できる（セットされると LoadCancelled を送出する）。
+        キャッシュが有効期間内で、前回マージしたときから songdata・キャッシュが変わっていなければ、
+        メモリ上に保持している結果を返す。
+        offline が真なら通信はせず、キャッシュがあれば有効期間が過ぎていてもそれを使い、なければ None を返す。
+        結果はハッシュによるマージのみで、「たぶん所持」は含まない（表示してから fetch_probable() で加える）
+        """
+        song_index = self.song_index
+        songdata_version = self.songdata_version
+
+        with instrument.span('load_table', table=self.table_list[table_index].get('name'), offline=offline) as span, \
+                self._table_cache_lock(table_index):
+            self._upgrade_table_cache(table_index)
+            if self._table_cache_exists(table_index) and (offline or self._table_cache_fresh(table_index)):
+                loaded = self.loaded_tables.get(table_index, self._loaded_stamp(table_index, songdata_version))
+                if loaded is not None:
+                    span.set(cache='memory', rows=len(loaded.df_table))
+                    return loaded
+
+            if offline and not self._table_cache_exists(table_index):
+                span.set(cache='miss')
+                return None
+
+            if offline:
+                span.set(cache='offline')
+                _notify(progress, 'キャッシュから難易度表を読み込み')
+                table_header, df_table_orig = self._load_table_cache(table_index)
+            elif not self._table_cache_exists(table_index):
+                span.set(cache='miss')
+                _notify(progress, 'キャッシュが存在しないので難易度表をダウンロード')
+                table_header, df_table_orig, cache_meta = self._download_table(table_index, progress, cancel_event)
+                _check_cancelled(cancel_event)
+                self._save_table_cache(table_index, table_header, df_table_orig, cache_meta)
+            elif not self._table_cache_fresh(table_index):
+                span.set(cache='stale')
+                _notify(progress, 'キャッシュの有効期間が過ぎたので難易度表の更新を確認')
+                table_header, df_table_orig = self._revalidate_table(table_index, progress, cancel_event)
+            else:
+                span.set(cache='hit')
+                _notify(progress, 'キャッシュから難易度表を読み込み')
+                table_header, df_table_orig = self._load_table_cache(table_index)
+
+            _check_cancelled(cancel_event)
+            _notify(progress, 'マージ')
+            df_table = self._merge_table_and_songdata(df_table_orig, song_index)
+            loaded = self._make_loaded(table_index, table_header, df_table_orig, df_table, songdata_version)
+            span.set(rows=len(df_table), found=int(df_table['found'].sum()))
+
+        self._keep_loaded(loaded)
+        return loaded
+
+    def set_loaded(self, loaded):
+        """fetch() などの結果を現在の難易度表とする。
+
+        マージし直しはしないので、読み込み中に songdata が更新されていた（is_stale() が真の）場合は、
+        呼び出し側で読み込み直すこと
+        """
+        self.table_header = loaded.table_header
+        self.df_table_orig = loaded.df_table_orig
+        self.df_table = loaded.df_table
+        self.df_table_view = loaded.df_table_view
+        self.row_details = loaded.row_details
+        self.current_table_index = loaded.table_index
+
+    def is_stale(self, loaded):
+        """loaded が、読み込み中に更新される前の songdata とマージしたものか"""
+        return loaded.songdata_version != self.songdata_version
+
+    def is_current(self, loaded):
+        """loaded が、現在の難易度表（set_loaded() したもの）から作られ、現在の songdata の版のものか"""
+        return (loaded.table_index == self.current_table_index
+                and loaded.df_table_orig is self.df_table_orig
+                and not self.is_stale(loaded))
+
+    def current_loaded(self):
+        """現在の難易度表を LoadedTable として返す（なければ None）"""
+        if self.current_table_index is None:
+            return None
+        return LoadedTable(self.current_table_index, self.table_header, self.df_table_orig, self.df_table,
+                           self.df_table_view, self.songdata_version, self.row_details)
+
+    def fetch_probable(self, loaded, progress=None, cancel_event=None):
+        """fetch() の結果に「たぶん所持」（probable_score, probable_path）を加えた LoadedTable を返す。
+
+        タイトル・アーティストの照合（と初回の TitleMatcher の作成）は時間がかかるので、
+        fetch() の結果を表示してから別スレッドで呼び出す。インスタンスの状態は変更しない。
+        songdata を読み込んでいない場合や、loaded が古い songdata の版のものなら None を返す
+        """
+        if 'probable_score' in loaded.df_table.columns:
+            return loaded
+
+        title_matcher = self._get_title_matcher(loaded.songdata_version)
+        if title_matcher is None:
+            return None
+        _check_cancelled(cancel_event)
+
+        df_table = loaded.df_table.copy(deep=False)
+        self._add_probably_owned(df_table, title_matcher)
+        # RowDetail に「たぶん所持」の格納パスが加わるので作り直す
+        loaded = self._make_loaded(loaded.table_index, loaded.table_header, loaded.df_table_orig, df_table,
+                                   loaded.songdata_version)
+        self._keep_loaded(loaded)
+        return loaded
+
+    def refresh_all(self, progress=None, cancel_event=None):
+        """すべての難易度表を並列にダウンロードし、キャッシュを更新する。
+
+        ダウンロードに失敗した難易度表について {table_index: 例外} を返す
+        """
+        table_count = len(self.table_list)
+        errors = {}
+        stats_before = downloader.stats()
+
+        # 同じホストの難易度表が続くと、スレッドがそのホストの接続の空きを待ってしまうので、ホストが交互になるよう並べる
+        order = downloader.order_by_host([table['url'] for table in self.table_list])
+        with ThreadPoolExecutor(max_workers=self.REFRESH_MAX_WORKERS) as executor:
+            futures = {executor.submit(self._refresh_table, i, cancel_event): i for i in order}
+            for done_count, future in enumerate(as_completed(futures), 1):
+                table_index = futures[future]
+                try:
+                    future.result()
+                except LoadCancelled:
+                    pass
+                except Exception as e:
+                    instrument.logger.warning(f'{self.table_list[table_index].get("name")}: {e}')
+                    errors[table_index] = e
+                _notify(progress, f'難易度表を更新中 ({done_count}/{table_count})')
+
+        instrument.event(f'ダウンロード: {downloader.format_stats(downloader.stats_since(stats_before))}')
+        _check_cancelled(cancel_event)
+        return errors
+
+    def ownership_summary(self, progress=None, cancel_event=None):
+        """キャッシュ済みのすべての難易度表について、レベルごとの所持・未所持の譜面数を集計する。
+
+        ownership.build_ownership_summary() の結果と、キャッシュがない難易度表の番号のリストを返す
+        """
+        song_index = self.song_index
+
+        with instrument.span('ownership_summary') as span:
+            tables, not_cached = self._load_cached_tables(ownership.SUMMARY_COLUMNS, cancel_event)
+            df_summary = ownership.build_ownership_summary(tables, song_index)
+            span.set(tables=len(tables), rows=int(df_summary['total'].sum()))
+
+        return df_summary, not_cached
+
+    def library_analysis(self, progress=None, cancel_event=None):
+        """songdata 全体について、重複所持している譜面と、フォルダごとの集計を求める。
 
-        self._merge_table_and_songdata()
+        フォルダがキャッシュ済みのどの難易度表にも載っていないかどうかも調べる。
+        library.analyze_library() の結果と、キャッシュがない難易度表の番号のリストを返す
+        """
+        df_songdata = self.df_songdata
+
+        with instrument.span('library_analysis', rows=len(df_songdata)) as span:
+            tables, not_cached = self._load_cached_tables(library.TABLE_COLUMNS, cancel_event)
+            analysis = library.analyze_library(df_songdata, [df_table for _, _, df_table in tables],
+                                               progress=progress, cancel_event=cancel_event)
+            span.set(tables=len(tables), duplicates=len(analysis.df_duplicates), folders=len(analysis.df_folders))
+
+        return analysis, not_cached
 
-        self.current_table_index = table_index
+    def _load_cached_tables(self, columns, cancel_event=None):
+        """キャッシュ済みの難易度表について、(table_index, 難易度表ヘッダ, 難易度表データの columns の列) のリストと、
+        キャッシュがない難易度表の番号のリストを返す
+        """
+        tables = []
+        not_cached = []
+        for table_index in range(len(self.table_list)):
+            _check_cancelled(cancel_event)
+            with self._table_cache_lock(table_index):
+                cache_dir = self._cache_dir_path(table_index)
+                df_table = None
+                if self._table_cache_exists(table_index):
+                    df_table = colcache.load_frame(f'{cache_dir}{self.CACHE_TABLE_DATA_DIR}', columns=columns)
+                if df_table is None:
+                    not_cached.append(table_index)
+                    continue
+                tables.append((table_index, self._load_table_header_cache(table_index), df_table))
+
+        _check_cancelled(cancel_event)
+        return tables, not_cached
+
+    def _refresh_table(self, table_index, cancel_event=None):
+        _check_cancelled(cancel_event)
+        with self._table_cache_lock(table_index):
+            self._upgrade_table_cache(table_index)
+            if self._table_cache_exists(table_index):
+                self._revalidate_table(table_index, cancel_event=cancel_event, fallback_to_cache=False)
+            else:
+                table_header, df_table_orig, cache_meta = self._download_table(table_index, cancel_event=cancel_event)
+                self._save_table_cache(table_index, table_header, df_table_orig, cache_meta)
+
+    @contextmanager
+    def _table_cache_lock(self, table_index):
+        """難易度表のキャッシュを読み書きする間、同じ難易度表のほかの読み書きを待たせる
+        （fetch() と refresh_all() が別スレッドで同じ難易度表を扱う場合など）
+        """
+        with self._table_cache_locks_lock:
+            if not table_index in self._table_cache_locks:
+                self._table_cache_locks[table_index] = threading.Lock()
+            lock = self._table_cache_locks[table_index]
+
+        with lock:
+            yield
+
+    def _revalidate_table(self, table_index, progress=None, cancel_event=None, fallback_to_cache=True):
+        """キャッシュ済みの難易度表を条件付きリクエストで再検証し、(難易度表ヘッダ, データ) を返す。
+
+        更新されていればキャッシュを書き換え、されていなければキャッシュの取得日時だけを更新する。
+        fallback_to_cache が真なら、通信に失敗したときは古いキャッシュを使う
+        """
+        cache_meta = self._load_cache_meta(table_index)
+        try:
+            downloaded = self._download_table(table_index, progress, cancel_event, cache_meta)
+        except requests.RequestException as e:
+            if not fallback_to_cache:
+                raise
+            _notify(progress, f'難易度表の更新を確認できないのでキャッシュを使用: {e}')
+            return self._load_table_cache(table_index)
+
+        if downloaded is None:
+            _notify(progress, '難易度表は更新されていません')
+            cache_meta['fetched_at'] = time.time()
+            self._save_cache_meta(table_index, cache_meta)
+            return self._load_table_cache(table_index)
+
+        table_header, df_table_orig, cache_meta = downloaded
+        self._save_table_cache(table_index, table_header, df_table_orig, cache_meta)
+        return table_header, df_table_orig
+
+    def merge_songdata_delta(self, loaded, delta, song_index, title_matcher=None):
+        """読み込み済みの難易度表（LoadedTable）に、songdata の差分（songdata.SongDataDelta）を反映したものを返す。
+
+        差分に含まれるハッシュを持つ曲だけを、新しい songdata の song_index でマージし直して found, path を更新する。
+        title_matcher（新しい songdata の fuzzymatch.TitleMatcher）を渡すと「たぶん所持」も探し直す。
+        インスタンスの状態は変更しないので、songdata の再読み込みと同じ別スレッドで呼び出し、結果を update_songdata() に渡す
+        """
+        df_table_orig = loaded.df_table_orig
+        affected = df_table_orig['md5'].isin(delta.changed_md5()) | df_table_orig['sha256'].isin(delta.changed_sha256())
+        if not affected.any() and title_matcher is None and not 'probable_score' in loaded.df_table.columns:
+            return loaded
+
+        # 「たぶん所持」は古い songdata で探したものなので、title_matcher がなければ捨てる（fetch_probable() で探し直す）
+        df_table = loaded.df_table.drop(columns=['probable_score', 'probable_path'], errors='ignore')
+        if affected.any():
+            with instrument.span('merge_delta', rows=int(affected.sum())):
+                path = song_index.resolve(df_table_orig.loc[affected, 'md5'], df_table_orig.loc[affected, 'sha256'])
+            df_table.loc[affected, 'path'] = path
+            df_table.loc[affected, 'found'] = path != ''
+
+        if title_matcher is not None:
+            self._add_probably_owned(df_table, title_matcher)
+
+        # 行の並びは変わらないが、RowDetail の「たぶん所持」の格納パスが変わるので作り直す
+        return self._make_loaded(loaded.table_index, loaded.table_header, df_table_orig, df_table,
+                                 loaded.songdata_version)
+
+    def update_songdata(self, df_songdata, delta, song_index=None, title_matcher=None, loaded=None):
+        """songdata の差分（songdata.SongDataDelta）を反映する。メインスレッドから呼び出す。
+
+        song_index に df_songdata の SongIndex を、title_matcher に fuzzymatch.TitleMatcher を、
+        loaded に現在の難易度表に差分を反映したもの（merge_songdata_delta()）を、別スレッドで作成しておいて渡す。
+        現在の難易度表を loaded に置き換えた（または現在の難易度表がない）場合は真を返す。
+        偽なら、loaded を作っている間に難易度表が切り替わっているので、読み込み直すこと。
+        メモリ上に保持している他の難易度表は破棄する
+        """
+        with self.title_matcher_lock:
+            self.df_songdata = df_songdata
+            self.song_index = song_index or SongIndex(df_songdata)
+            if delta.empty():
+                return True
+
+            # title_matcher がなければ、次に fetch_probable() を呼び出したときに作る
+            self.songdata_version += 1
+            self.title_matcher = title_matcher
+
+        # 保持している他の難易度表はマージし直しが必要になる
+        self.loaded_tables.clear()
+
+        if self.current_table_index is None:
+            return True
+        if loaded is None or loaded.table_index != self.current_table_index or loaded.df_table_orig is not self.df_table_orig:
+            return False
+
+        loaded = loaded._replace(songdata_version=self.songdata_version)
+        self.set_loaded(loaded)
+        self._keep_loaded(loaded)
+        return True
+
+    def _make_loaded(self, table_index, table_header, df_table_orig, df_table, songdata_version):
+        """マージ結果から表示用のデータを作り、LoadedTable にまとめる"""
+        df_table_view = make_table_view(table_header, df_table)
+        row_details = make_row_details(df_table_view)
+        return LoadedTable(table_index, table_header, df_table_orig, df_table, df_table_view, songdata_version, row_details)
+
+    def _keep_loaded(self, loaded):
+        size = loaded.df_table.memory_usage(deep=True).sum() + loaded.df_table_view.memory_usage(deep=True).sum()
+        size += sum(sys.getsizeof(detail) + sum(map(sys.getsizeof, detail)) for detail in loaded.row_details)
+        self.loaded_tables.put(loaded.table_index, loaded, self._loaded_stamp(loaded.table_index, loaded.songdata_version), size)
+
+    def _loaded_stamp(self, table_index, songdata_version):
+        """マージ結果が有効かを判定するための値（songdata の版、キャッシュファイルの更新日時）"""
+        cache_dir = self._cache_dir_path(table_index)
+        try:
+            header_mtime = os.stat(f'{cache_dir}table_header.json').st_mtime_ns
+            data_mtime = os.stat(f'{cache_dir}{self.CACHE_TABLE_DATA_DIR}{colcache.MANIFEST_FILE}').st_mtime_ns
+        except OSError:
+            return None
+        return songdata_version, header_mtime, data_mtime
 
     def _table_cache_exists(self, table_index):
         cache_dir = self._cache_dir_path(table_index)
         cache_files = [f'{cache_dir}{cache_file}' for cache_file in self.CACHE_FILE_LIST]
-        return _files_exist_all(cache_files)
+        return _files_exist_all(cache_files) and colcache.is_valid(f'{cache_dir}{self.CACHE_TABLE_DATA_DIR}')
+
+    def _upgrade_table_cache(self, table_index):
+        """以前の形式（pickle）のキャッシュがあれば、列ごとの形式に変換する"""
+        cache_dir = self._cache_dir_path(table_index)
+        legacy_path = f'{cache_dir}{self.LEGACY_CACHE_TABLE_DATA_FILE}'
+        if not os.path.isfile(legacy_path):
+            return
+
+        if not colcache.is_valid(f'{cache_dir}{self.CACHE_TABLE_DATA_DIR}'):
+            instrument.event('キャッシュを新しい形式に変換', table=self.table_list[table_index].get('name'))
+            colcache.save_frame(pd.read_pickle(legacy_path), f'{cache_dir}{self.CACHE_TABLE_DATA_DIR}')
+        os.remove(legacy_path)
 
     def _cache_dir_path(self, table_index=None):
         cache_root = self.CACHE_ROOT_DIR
@@ -94,91 +701,221 @@ class BmsTable():
     def _table_cache_hash(self, table_index):
         return md5(self.table_list[table_index]['url'].encode()).hexdigest()
 
-    def _download_table(self, table_index):
+    def _table_cache_fresh(self, table_index):
+        ttl_hours = self.table_list[table_index].get('ttl_hours', self.DEFAULT_CACHE_TTL_HOURS)
+        fetched_at = self._load_cache_meta(table_index).get('fetched_at', 0)
+        return time.time() - fetched_at < ttl_hours * 3600
+
+    def _download_table(self, table_index, progress=None, cancel_event=None, cache_meta=None):
+        """難易度表をダウンロードし、(難易度表ヘッダ, データ, キャッシュのメタデータ) を返す。
+
+        cache_meta（前回ダウンロード時のメタデータ）を指定すると条件付きリクエストを行う。
+        難易度表ヘッダ・データがともに更新されていなければ、JSON の解析などは行わずに None を返す
+        """
+        with instrument.span('download_table', table=self.table_list[table_index].get('name')) as span:
+            downloaded = self._download_table_data(table_index, progress, cancel_event, cache_meta or {})
+            span.set(not_modified=downloaded is None)
+            return downloaded
+
+    def _download_table_data(self, table_index, progress, cancel_event, cache_meta):
         # 難易度表ヘッダを取得
-        print('難易度表ヘッダを取得')
-        table_header_json_url = self._get_table_header_json_url(table_index)
-        table_header = _get_json(table_header_json_url)
+        _notify(progress, '難易度表ヘッダを取得')
+        table_header_json_url = self._get_table_header_json_url(table_index, cancel_event)
+        table_header, header_validators = _get_json(table_header_json_url, cache_meta.get('header'), cancel_event)
+        _check_cancelled(cancel_event)
+
+        header_modified = table_header is not None
+        if not header_modified:
+            table_header = self._load_table_header_cache(table_index)
 
         # 難易度表を取得
-        print('難易度表を取得')
+        _notify(progress, '難易度表を取得')
         table_data_url = urljoin(table_header_json_url, table_header['data_url'])
-        table_data = _get_json(table_data_url)
-        df_table_orig = pd.DataFrame(table_data)
+        table_data, data_validators = _get_json_columns(table_data_url, self.TABLE_DATA_COLUMNS, cache_meta.get('data'), cancel_event)
+
+        new_cache_meta = {
+            'fetched_at': time.time(),
+            'header': header_validators,
+            'data': data_validators,
+        }
+
+        if table_data is None:
+            if not header_modified:
+                return None
+            # 難易度表ヘッダのみ更新されている
+            _, df_table_orig = self._load_table_cache(table_index)
+            return table_header, df_table_orig, new_cache_meta
+
+        df_table_orig = pd.DataFrame(table_data, columns=[c for c in self.TABLE_DATA_COLUMNS if c in table_data])
+        if not 'md5' in df_table_orig.columns:
+            df_table_orig['md5'] = np.nan
         df_table_orig['md5'] = df_table_orig['md5'].replace('', np.nan)
         if not 'sha256' in df_table_orig.columns:
             df_table_orig['sha256'] = ''
         df_table_orig.reset_index(inplace=True)
         #df_table_orig.to_csv('_debug/df_table_orig.csv')
 
-        self.table_header = table_header
-        self.df_table_orig = df_table_orig
+        return table_header, df_table_orig, new_cache_meta
 
-    def _merge_table_and_songdata(self):
+    def _merge_table_and_songdata(self, df_table_orig, song_index):
         """ダウンロードした難易度表とsongdata.dbの内容をマージする
 
-        難易度表の各曲のハッシュ（md5, sha256）によりマージし、
+        難易度表の各曲のハッシュ（md5, sha256）を songdata の索引で引き、
         所持しているか（found）、格納パス（path）を得る
-        """
 
-        # 難易度表とsong.dbから、所持している譜面を取得(1)
-        # md5による
-        print('マージ(md5)')
-        df_merged_md5 = pd.merge(self.df_table_orig, self.df_songdata, on='md5', how='left', suffixes=(None, '_r'))
-        try:
-            df_merged_md5.drop(columns=['sha256_r'], inplace=True)
-        except:
-            print('sha256 property not found.')
-
-        # 難易度表とsong.dbから、所持している譜面を取得(2)
-        # sha256による
-        print('マージ(sha256)')
-        df_merged_sha256 = pd.merge(self.df_table_orig, self.df_songdata, on='sha256', how='inner', suffixes=(None, '_r'))
-
-        # (1),(2)の結果をマージ
-        # これにより df_table の内容は次のようになる：
-        # - ベースは難易度表のデータ
-        # - 所持していれば path に保存先が格納されている
-        # - 重複所持していると、曲が同じで path が異なる行が複数となる
-        # - 難易度表の行番号が index に格納されている。リスト表示で曲の重複をしたくない場合は index の重複を削除する
-        print('マージ')
-        df_table = pd.merge(df_merged_md5, df_merged_sha256[['sha256', 'path']], on='sha256', how='left', suffixes=(None, '_r2'))
-        df_table['path'] = df_table['path'].fillna('')
-        df_table['path_r2'] = df_table['path_r2'].fillna('')
-        df_table['path'] = df_table['path'] + df_table['path_r2']
-        df_table['found'] = df_table['path'] != ''
-        #df_table.to_csv('_debug/df_table.csv')
-
-        self.df_table = df_table
-
-    def _get_table_header_json_url(self, table_index):
-        table_html_text = _get_html_text(self.table_list[table_index]['url'])
+        df_table の内容は次のようになる：
+        - ベースは難易度表のデータ（行の並び・インデックスも難易度表と同じ）
+        - 所持していれば path に保存先が格納されている
+        - 重複所持している場合は、songdata 上で先に現れる path となる
+        - 難易度表の行番号が index に格納されている
+        """
+        with instrument.span('merge', rows=len(df_table_orig)):
+            df_table = df_table_orig.copy(deep=False)
+            df_table['path'] = song_index.resolve(df_table_orig['md5'], df_table_orig['sha256'])
+            df_table['found'] = df_table['path'] != ''
+            #df_table.to_csv('_debug/df_table.csv')
+
+        return df_table
+
+    def _add_probably_owned(self, df_table, title_matcher):
+        """未所持の曲について、タイトル・アーティストが似ている曲を探す（列 probable_score, probable_path を加える）"""
+        with instrument.span('match_titles') as span:
+            df_probable = fuzzymatch.find_probably_owned(title_matcher, df_table)
+            df_table['probable_score'] = df_probable['probable_score']
+            df_table['probable_path'] = df_probable['probable_path']
+            span.set(probable=int((df_probable['probable_score'] > 0).sum()))
+
+    def _get_title_matcher(self, songdata_version):
+        """songdata の版が songdata_version のときの fuzzymatch.TitleMatcher を返す（なければ作る）。
+
+        songdata を読み込んでいない場合や、songdata がすでに更新されている場合は None
+        """
+        with self.title_matcher_lock:
+            if songdata_version != self.songdata_version or self.df_songdata is None:
+                return None
+            if self.title_matcher is not None:
+                return self.title_matcher
+            df_songdata = self.df_songdata
+
+        # 作成には時間がかかるので、その間 update_songdata() を待たせないようロックの外で作る
+        with instrument.span('build_title_matcher', rows=len(df_songdata)):
+            title_matcher = fuzzymatch.TitleMatcher(df_songdata)
+
+        with self.title_matcher_lock:
+            if songdata_version != self.songdata_version:
+                return None
+            if self.title_matcher is None:
+                self.title_matcher = title_matcher
+            return self.title_matcher
+
+    def _get_table_header_json_url(self, table_index, cancel_event=None):
+        table_html_text = _get_html_text(self.table_list[table_index]['url'], cancel_event)
         html_parser = HtmlBmsTableParser()
         html_parser.feed(table_html_text)
         table_header_url = html_parser.get_table_header_json_url()
+        if not table_header_url:
+            raise ValueError('難易度表の HTML に <meta name="bmstable"> がありません')
         return urljoin(self.table_list[table_index]['url'], table_header_url)
 
-    def _save_table_cache(self, table_index):
-        cache_root_dir = self._cache_dir_path()
-        if not os.path.isdir(cache_root_dir):
-            os.mkdir(cache_root_dir)
-
+    def _save_table_cache(self, table_index, table_header, df_table_orig, cache_meta):
         cache_dir = self._cache_dir_path(table_index)
-        if not os.path.isdir(cache_dir):
-            os.mkdir(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
 
         with open(f'{cache_dir}table_header.json', 'wt') as f:
-            json.dump(self.table_header, f)
+            json.dump(table_header, f)
         
-        self.df_table_orig.to_pickle(f'{cache_dir}df_table.pkl')
+        colcache.save_frame(df_table_orig, f'{cache_dir}{self.CACHE_TABLE_DATA_DIR}')
+
+        self._save_cache_meta(table_index, cache_meta)
+        self.loaded_tables.discard(table_index)
 
     def _load_table_cache(self, table_index):
+        table_header = self._load_table_header_cache(table_index)
+
+        cache_dir = self._cache_dir_path(table_index)
+        with instrument.span('load_table_cache') as span:
+            df_table_orig = colcache.load_frame(f'{cache_dir}{self.CACHE_TABLE_DATA_DIR}')
+            if df_table_orig is None:
+                raise FileNotFoundError(f'{cache_dir}{self.CACHE_TABLE_DATA_DIR}: 難易度表のキャッシュがありません')
+            span.set(rows=len(df_table_orig))
+
+        return table_header, df_table_orig
+
+    def _load_table_header_cache(self, table_index):
         cache_dir = self._cache_dir_path(table_index)
 
         with open(f'{cache_dir}table_header.json') as f:
-            table_header = json.load(f)
+            return json.load(f)
 
-        df_table_orig = pd.read_pickle(f'{cache_dir}df_table.pkl')
+    def _save_cache_meta(self, table_index, cache_meta):
+        cache_dir = self._cache_dir_path(table_index)
 
-        self.table_header = table_header
-        self.df_table_orig = df_table_orig
+        with open(f'{cache_dir}{self.CACHE_META_FILE}', 'wt') as f:
+            json.dump(cache_meta, f)
+
+    def _load_cache_meta(self, table_index):
+        """キャッシュのメタデータ（取得日時、ETag, Last-Modified）を読み込む。なければ {} を返す"""
+        meta_path = f'{self._cache_dir_path(table_index)}{self.CACHE_META_FILE}'
+        if not os.path.isfile(meta_path):
+            return {}
+
+        with open(meta_path) as f:
+            return json.load(f)
+
+
+def make_table_view(table_header, df_table):
+    """シート表示用の譜面リストを作成する。
+
+    - level を、level_order の順（level_order にないレベルはその後に登場順）の順序付きカテゴリにする
+    - シートに表示するレベル（記号つき）を level_label とする
+    - 難易度表ヘッダに 'level_order' の指定がある場合は並び替え（level_order にないレベルは元の順で後ろに回す）
+
+    マージ結果は難易度表の 1 行につき 1 行なので、重複の削除は不要
+    """
+    # 文字列への変換・順位の計算は、異なるレベルの値ごとに一度だけ行う
+    codes, uniques = pd.factorize(df_table['level'], use_na_sentinel=False)
+    names = [str(x) for x in uniques]
+    level_order = list(dict.fromkeys(str(x) for x in table_header.get('level_order', [])))
+    categories = list(dict.fromkeys(level_order + names))
+    position = {name: i for i, name in enumerate(categories)}
+    level_codes = np.array([position[name] for name in names], dtype=np.int32)[codes]
+
+    symbol = table_header.get('symbol', '')
+    df = df_table.copy(deep=False)
+    df['level'] = pd.Categorical.from_codes(level_codes, categories=categories, ordered=True)
+    df['level_label'] = np.array([symbol + name for name in categories], dtype=object)[level_codes]
+
+    if level_order:
+        rank = np.minimum(level_codes, len(level_order))
+        df = df.iloc[np.argsort(rank, kind='stable')]
+
+    return df
+
+
+def make_row_details(df_table_view):
+    """df_table_view の各行の RowDetail のリストを、列ごとにまとめて作る"""
+    def text(column):
+        if not column in df_table_view.columns:
+            return pd.Series('', index=df_table_view.index, dtype=object)
+        return df_table_view[column].fillna('').astype(str).astype(object)
+
+    title, md5 = text('title'), text('md5')
+    url, url_diff, name_diff = text('url'), text('url_diff'), text('name_diff')
+    url_pack, name_pack = text('url_pack'), text('name_pack')
+
+    ir_url = (LR2IR_RANKING_URL + md5).where(md5 != '', '')
+    url_diff_text = url_diff + ' ' + ('- ' + name_diff).where(name_diff != '', '')
+    url_pack_text = (url_pack + ' ' + ('- ' + name_pack).where(name_pack != '', '')).where(url_pack != '', '')
+    search_text = title.str.replace(r'\s*\[.[^\[]+\]$', '', regex=True)
+
+    probable_text = pd.Series('', index=df_table_view.index, dtype=object)
+    probable_dir = probable_text
+    if 'probable_score' in df_table_view.columns:
+        probable = (df_table_view['probable_score'] > 0) & ~df_table_view['found'].astype(bool)
+        probable_path = df_table_view['probable_path'].where(probable, '').astype(object)
+        score_text = (df_table_view['probable_score'] * 100).round().astype(int).astype(str)
+        probable_text = ('たぶん所持（' + score_text + '%）: ' + probable_path).where(probable, '').astype(object)
+        probable_dir = probable_path.map(os.path.dirname)
+
+    columns = [title, ir_url, url, url_diff, url_diff_text, url_pack, url_pack_text, search_text, probable_text, probable_dir]
+    return list(map(RowDetail._make, zip(*(c.to_numpy(dtype=object) for c in columns))))
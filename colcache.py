@@ -0,0 +1,188 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# 形式を変更したら上げる（古い形式のキャッシュは無効となり、作り直される）
+FORMAT_VERSION = 1
+
+MANIFEST_FILE = 'manifest.json'
+
+# 文字列の列を連結するときの区切り文字の候補（値に含まれないものを使う）
+STRING_SEPARATORS = ['\x1f', '\x1e', '\x00']
+
+
+def save_frame(df, cache_dir):
+    """DataFrame を列ごとのファイルに分けて cache_dir に保存する。
+
+    - 数値・真偽値の列: .npy（np.load の mmap_mode で読める）
+    - 文字列の列: UTF-8 の連結テキスト + 欠損値のマスク（.npy）
+      （値に含まれない制御文字で区切る。どれも含まれる場合は各値の開始位置（.npy）も保存する）
+    - category 型の列: コード（.npy）+ カテゴリの一覧（文字列の列と同じ形式）
+    - それ以外の列: JSON
+    列の一覧・形式のバージョンは manifest.json に書く。
+
+    同じフォルダ内の一時フォルダに書き出してから cache_dir と入れ替えるので、
+    読み込む側が書きかけのキャッシュを読むことはない（入れ替えの間は、キャッシュなしとして扱われる）
+    """
+    cache_dir = os.path.normpath(cache_dir)
+    parent_dir = os.path.dirname(cache_dir) or '.'
+    os.makedirs(parent_dir, exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(prefix=f'{os.path.basename(cache_dir)}.tmp', dir=parent_dir)
+    try:
+        _write_frame(df, tmp_dir)
+        _replace_dir(tmp_dir, cache_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def _write_frame(df, cache_dir):
+    columns = [_save_column(df[name], cache_dir, f'col{i}', name) for i, name in enumerate(df.columns)]
+
+    # 既定の RangeIndex（0, 1, 2, ...）以外のインデックスは列と同様に保存する
+    index = None
+    if not df.index.equals(pd.RangeIndex(len(df))) or df.index.name is not None:
+        index = _save_column(df.index.to_series(), cache_dir, 'index', df.index.name)
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'rows': len(df),
+        'columns': columns,
+        'index': index,
+    }
+    with open(os.path.join(cache_dir, MANIFEST_FILE), 'wt', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+
+def _replace_dir(src_dir, dst_dir):
+    # 中身のあるフォルダは os.replace() で上書きできないので、古いほうを別名にしてから入れ替え、削除する
+    if not os.path.isdir(dst_dir):
+        os.rename(src_dir, dst_dir)
+        return
+
+    old_dir = f'{src_dir}.old'
+    os.rename(dst_dir, old_dir)
+    try:
+        os.rename(src_dir, dst_dir)
+    except OSError:
+        os.rename(old_dir, dst_dir)
+        raise
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def is_valid(cache_dir):
+    """cache_dir に現在の形式のキャッシュがあるか"""
+    manifest = _load_manifest(cache_dir)
+    return manifest is not None and manifest.get('format_version') == FORMAT_VERSION
+
+
+def load_frame(cache_dir, columns=None, mmap=False):
+    """save_frame() で保存した DataFrame を読み込む。現在の形式のキャッシュがなければ None を返す。
+
+    columns を指定すると、その列のファイルだけを読み込む。
+    mmap が真なら数値の列はメモリマップしたまま使う
+    （Windows ではマップ中のファイルを上書きできないので、キャッシュを書き換える可能性がある場合は偽とする）
+    """
+    manifest = _load_manifest(cache_dir)
+    if manifest is None or manifest.get('format_version') != FORMAT_VERSION:
+        return None
+
+    column_specs = manifest['columns']
+    if columns is not None:
+        column_specs = [spec for spec in column_specs if spec['name'] in columns]
+
+    data = {spec['name']: _load_column(cache_dir, spec, mmap) for spec in column_specs}
+
+    index = None
+    if manifest['index']:
+        index = pd.Index(_load_column(cache_dir, manifest['index'], mmap), name=manifest['index']['name'])
+    elif not data:
+        index = pd.RangeIndex(manifest['rows'])
+
+    return pd.DataFrame(data, index=index)
+
+
+def _load_manifest(cache_dir):
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_column(series, cache_dir, file_stem, name):
+    spec = {'name': name, 'file': file_stem}
+
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        spec['kind'] = 'category'
+        np.save(os.path.join(cache_dir, f'{file_stem}.codes.npy'), series.cat.codes.to_numpy())
+        spec['categories'] = _save_column(series.cat.categories.to_series(), cache_dir, f'{file_stem}.categories', None)
+
+    elif isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+        spec['kind'] = 'numeric'
+        np.save(os.path.join(cache_dir, f'{file_stem}.npy'), series.to_numpy())
+
+    elif pd.api.types.infer_dtype(series, skipna=True) in ('string', 'empty'):
+        spec['kind'] = 'string'
+        nulls = series.isna().to_numpy()
+        values = series.to_numpy(dtype=object, copy=True)
+        values[nulls] = ''
+        np.save(os.path.join(cache_dir, f'{file_stem}.nulls.npy'), nulls)
+
+        text = ''.join(values)
+        spec['separator'] = next((sep for sep in STRING_SEPARATORS if not sep in text), None)
+        if spec['separator'] is None:
+            lengths = np.fromiter((len(v) for v in values), dtype=np.int64, count=len(values))
+            np.save(os.path.join(cache_dir, f'{file_stem}.offsets.npy'), np.concatenate([[0], np.cumsum(lengths)]))
+        else:
+            text = spec['separator'].join(values)
+
+        with open(os.path.join(cache_dir, f'{file_stem}.txt'), 'wt', encoding='utf-8', newline='') as f:
+            f.write(text)
+
+    else:
+        spec['kind'] = 'json'
+        with open(os.path.join(cache_dir, f'{file_stem}.json'), 'wt', encoding='utf-8') as f:
+            json.dump(series.tolist(), f, ensure_ascii=False, default=str)
+
+    return spec
+
+
+def _load_column(cache_dir, spec, mmap=False):
+    file_stem = os.path.join(cache_dir, spec['file'])
+
+    if spec['kind'] == 'numeric':
+        return np.load(f'{file_stem}.npy', mmap_mode='r' if mmap else None)
+
+    if spec['kind'] == 'category':
+        codes = np.load(f'{file_stem}.codes.npy')
+        categories = _load_column(cache_dir, spec['categories'])
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+    if spec['kind'] == 'string':
+        nulls = np.load(f'{file_stem}.nulls.npy')
+        with open(f'{file_stem}.txt', encoding='utf-8', newline='') as f:
+            text = f.read()
+
+        values = np.empty(len(nulls), dtype=object)
+        if len(nulls) == 0:
+            return values
+
+        if spec['separator'] is None:
+            offsets = np.load(f'{file_stem}.offsets.npy').tolist()
+            values[:] = [text[begin:end] for begin, end in zip(offsets[:-1], offsets[1:])]
+        else:
+            values[:] = text.split(spec['separator'])
+        values[nulls] = np.nan
+        return values
+
+    with open(f'{file_stem}.json', encoding='utf-8') as f:
+        data = json.load(f)
+    values = np.empty(len(data), dtype=object)
+    values[:] = data
+    return values
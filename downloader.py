@@ -0,0 +1,294 @@
+import time
+import threading
+import requests
+from urllib.parse import urlsplit
+from collections import namedtuple
+from contextlib import contextmanager
+
+import instrument
+
+
+# 同じホストへの同時接続数の上限
+MAX_CONNECTIONS_PER_HOST = 2
+
+# 本文を受信する単位（バイト）
+CHUNK_SIZE = 64 * 1024
+
+# HTTP の (接続, 受信) のタイムアウト（秒）
+HTTP_TIMEOUT = (10, 30)
+
+# 接続エラー・タイムアウト・一時的なエラー（HTTP_RETRY_STATUS）のときの再試行回数と、
+# 最初の再試行までの待ち時間（秒。再試行のたびに倍にする）。受信の途中で切れた場合の再開もこの回数まで
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF_SECONDS = 1.0
+HTTP_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# 受け付ける圧縮形式。gzip, deflate のほか、brotli（または brotlicffi）がインストールされていれば br も
+ACCEPT_ENCODING = requests.utils.DEFAULT_ACCEPT_ENCODING
+
+# ホストごとの通信量の集計（stats）
+# - requests: リクエスト数（再試行・再開を含む）
+# - retries: 再試行した回数、resumed: 受信の途中で切れて再開した回数
+# - bytes: 受信した本文のバイト数（展開後）、wire_bytes: 圧縮されたままのバイト数
+# - seconds: リクエストを送ってから本文を受信し終わるまでの時間の合計
+DownloadStats = namedtuple('DownloadStats', ['requests', 'retries', 'resumed', 'bytes', 'wire_bytes', 'seconds'])
+
+# 全スレッドで共有する HTTP セッション（ホストごとに接続を使い回す）
+_session = requests.Session()
+_session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=MAX_CONNECTIONS_PER_HOST))
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=MAX_CONNECTIONS_PER_HOST))
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+# 受信の途中で切れたとみなす例外
+_interrupted_errors = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# 再開のリクエストでは送らないヘッダ（最初のレスポンスは 304 ではなかったので）
+_conditional_header_names = {'if-none-match', 'if-modified-since'}
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def get(url, headers=None, cancel_event=None):
+    """GET リクエストを送り、本文まで受信したレスポンスを返す（難易度表の HTML、ヘッダなどの小さいもの向け）"""
+    with instrument.span('http_get', url=url) as span, _host_slot(url):
+        start = time.perf_counter()
+        res = request(url, headers, cancel_event=cancel_event)
+        content = res.content
+        _record(span, url, res.status_code, len(content), _wire_bytes(res), time.perf_counter() - start)
+        return res
+
+
+class Download():
+    """本文を少しずつ受信するダウンロード（難易度表データなどの大きいもの向け）。
+
+        with Download(url, headers, cancel_event) as download:
+            if download.status_code == 200:
+                for chunk in download.chunks():
+                    ...
+
+    受信の途中で接続が切れた場合は、受信済みの位置から再開する。
+    サーバが Range に対応していれば続きだけを、そうでなければ先頭から受信し直して受信済みの分を読み捨てる。
+    どちらの場合も ETag / Last-Modified が最初のレスポンスと同じであることを確認する
+    """
+
+    def __init__(self, url, headers=None, cancel_event=None):
+        self.url = url
+        self.headers = dict(headers or {})
+        self.cancel_event = cancel_event
+        self.response = None
+        self.bytes = 0
+        self.wire_bytes = 0
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    def __enter__(self):
+        self.span = instrument.span('http_get', url=self.url, stream=True).__enter__()
+        self._slot = _host_slot(self.url)
+        self._slot.__enter__()
+        self.start = time.perf_counter()
+        try:
+            self.response = request(self.url, self.headers, stream=True, cancel_event=self.cancel_event)
+        except BaseException as e:
+            self._exit(type(e), e, e.__traceback__)
+            raise
+        self._body = self.response
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._exit(exc_type, exc, tb)
+
+    def _exit(self, exc_type, exc, tb):
+        if self.response is not None:
+            if self._body is not None:
+                self.wire_bytes += _wire_bytes(self._body)
+                self._body.close()
+            _record(self.span, self.url, self.response.status_code, self.bytes, self.wire_bytes,
+                    time.perf_counter() - self.start)
+        self._slot.__exit__(exc_type, exc, tb)
+        return self.span.__exit__(exc_type, exc, tb)
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """本文（展開後）を chunk_size バイト程度ずつ返す"""
+        resumes = 0
+        skip = 0
+        while True:
+            try:
+                for chunk in self._body.iter_content(chunk_size):
+                    _check_cancelled(self.cancel_event)
+                    if skip > 0:
+                        # 先頭から受信し直している場合は、受信済みの分を読み捨てる
+                        chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                        if not chunk:
+                            continue
+                    self.bytes += len(chunk)
+                    yield chunk
+                return
+
+            except _interrupted_errors as e:
+                if resumes == HTTP_RETRIES:
+                    raise
+                _wait_before_retry(self.url, f'受信中に {type(e).__name__}', resumes, self.cancel_event)
+                resumes += 1
+                skip = self._resume()
+                _count(self.url, resumed=1)
+
+    def _resume(self):
+        """受信済みの位置から再開するリクエストを送り、読み捨てるバイト数を返す"""
+        self.wire_bytes += _wire_bytes(self._body)
+        self._body.close()
+        self._body = None
+
+        validator = self.response.headers.get('ETag') or self.response.headers.get('Last-Modified')
+        headers = {k: v for k, v in self.headers.items() if not k.lower() in _conditional_header_names}
+        ranged = (validator is not None
+                  and self.response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+                  and self.response.headers.get('Content-Encoding', 'identity').lower() == 'identity')
+        if ranged:
+            # 圧縮されていると受信済みのバイト数と本文の位置が合わないので、圧縮しないよう求める
+            headers.update({'Range': f'bytes={self.bytes}-', 'If-Range': validator, 'Accept-Encoding': 'identity'})
+
+        self._body = request(self.url, headers, stream=True, cancel_event=self.cancel_event)
+        if self._body.status_code == 206 and ranged and _range_start(self._body) == self.bytes:
+            return 0
+        if self._body.status_code == 200 and self._same_content(self._body):
+            return self.bytes
+
+        raise requests.ConnectionError(f'{self.url}: 受信を再開できません（HTTP {self._body.status_code}）')
+
+    def _same_content(self, res):
+        for name in ('ETag', 'Last-Modified'):
+            if self.response.headers.get(name) != res.headers.get(name):
+                return False
+        return True
+
+
+def request(url, headers=None, stream=False, cancel_event=None):
+    """GET リクエストを送る（タイムアウトつき）。
+
+    接続エラー・タイムアウト・一時的なエラーの場合は、待ち時間を倍にしながら HTTP_RETRIES 回まで再試行する。
+    最終的なレスポンスが 2xx, 304 以外なら requests.HTTPError を送出する
+    （エラーページを難易度表として解析せず、呼び出し側でキャッシュを使うなどできるように）
+    """
+    for attempt in range(HTTP_RETRIES + 1):
+        _check_cancelled(cancel_event)
+        _count(url, requests=1)
+        try:
+            res = _session.get(url, headers=headers, stream=stream, timeout=HTTP_TIMEOUT)
+            if not res.status_code in HTTP_RETRY_STATUS or attempt == HTTP_RETRIES:
+                if not (200 <= res.status_code < 300 or res.status_code == 304):
+                    res.close()
+                    raise requests.HTTPError(f'HTTP {res.status_code} {res.reason}: {url}', response=res)
+                return res
+            res.close()
+            reason = f'HTTP {res.status_code}'
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == HTTP_RETRIES:
+                raise
+            reason = type(e).__name__
+
+        _wait_before_retry(url, reason, attempt, cancel_event)
+        _count(url, retries=1)
+
+
+def order_by_host(urls):
+    """urls の添字を、同じホストが続かないように（ホストごとに 1 つずつ順に）並べたリストを返す。
+
+    同時接続数はホストごとに制限しているので、同じホストのダウンロードが続くとスレッドがその空きを待ってしまう
+    """
+    by_host = {}
+    for i, url in enumerate(urls):
+        by_host.setdefault(urlsplit(url).netloc, []).append(i)
+
+    order = []
+    queues = list(by_host.values())
+    for rank in range(max(map(len, queues), default=0)):
+        order.extend(queue[rank] for queue in queues if rank < len(queue))
+    return order
+
+
+def stats(host=None):
+    """これまでの通信量（DownloadStats）を返す。host を指定しなければ全ホストの合計"""
+    with _stats_lock:
+        if host is not None:
+            return DownloadStats(*_stats.get(host, [0] * len(DownloadStats._fields)))
+        return DownloadStats(*map(sum, zip(*_stats.values()))) if _stats else DownloadStats(0, 0, 0, 0, 0, 0.0)
+
+
+def stats_since(before):
+    """stats() で取得した before から、現在までの通信量（全ホストの合計）を返す"""
+    return DownloadStats(*(now - then for now, then in zip(stats(), before)))
+
+
+def format_stats(s):
+    """DownloadStats をログ用の文字列にする"""
+    throughput = s.bytes / s.seconds / 1024 if s.seconds > 0 else 0
+    return (f'{s.requests} リクエスト（再試行 {s.retries}, 再開 {s.resumed}）, '
+            f'{s.bytes / 1024:.1f} KiB（転送 {s.wire_bytes / 1024:.1f} KiB）, {throughput:.1f} KiB/s')
+
+
+@contextmanager
+def _host_slot(url):
+    """同じホストへの同時接続数を MAX_CONNECTIONS_PER_HOST までに制限する"""
+    host = urlsplit(url).netloc
+    with _host_semaphores_lock:
+        if not host in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        semaphore = _host_semaphores[host]
+
+    with semaphore:
+        yield
+
+
+def _wait_before_retry(url, reason, attempt, cancel_event):
+    delay = HTTP_RETRY_BACKOFF_SECONDS * 2 ** attempt
+    instrument.logger.warning(f'{url}: {reason}。{delay:g} 秒後に再試行します')
+    if cancel_event:
+        if cancel_event.wait(delay):
+            raise DownloadCancelled()
+    else:
+        time.sleep(delay)
+
+
+def _check_cancelled(cancel_event):
+    if cancel_event and cancel_event.is_set():
+        raise DownloadCancelled()
+
+
+def _range_start(res):
+    # Content-Range: bytes 100-199/200
+    try:
+        return int(res.headers.get('Content-Range', '').split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _wire_bytes(res):
+    # 圧縮されたままの（urllib3 が読んだ）バイト数
+    try:
+        return res.raw.tell()
+    except (AttributeError, OSError):
+        return 0
+
+
+def _count(url, **counts):
+    fields = DownloadStats._fields
+    with _stats_lock:
+        values = _stats.setdefault(urlsplit(url).netloc, [0] * len(fields))
+        for name, value in counts.items():
+            values[fields.index(name)] += value
+
+
+def _record(span, url, status, body_bytes, wire_bytes, seconds):
+    span.set(status=status, bytes=body_bytes, wire_bytes=wire_bytes,
+             kib_per_s=round(body_bytes / seconds / 1024, 1) if seconds > 0 else 0)
+    _count(url, bytes=body_bytes, wire_bytes=wire_bytes, seconds=seconds)
@@ -0,0 +1,172 @@
+import re
+import unicodedata
+import numpy as np
+import pandas as pd
+from difflib import SequenceMatcher
+
+import songdata
+
+
+# この値以上の類似度なら「たぶん所持」とする
+PROBABLY_OWNED_SCORE = 0.85
+
+# 類似度の重み（タイトル, アーティスト, 差分名）
+SCORE_WEIGHTS = (0.6, 0.3, 0.1)
+
+# 両方に差分名がある場合、差分名の類似度がこの値未満なら別の譜面とする
+# （差分名の重みは小さいので、[ANOTHER] と [HYPER] のように違っていてもタイトル・アーティストだけで PROBABLY_OWNED_SCORE を超えてしまう）
+DIFF_MATCH_SCORE = 0.8
+
+# 正規化したタイトルが一致しない場合に、先頭の何文字が同じタイトルを候補とするか
+PREFIX_LENGTH = 4
+# 先頭の文字が同じタイトルが多すぎる場合は、長さの近いものからこの数までしか比べない
+MAX_PREFIX_CANDIDATES = 50
+
+# タイトル末尾の差分名（[ANOTHER], 【SP】, -HYPER- など）
+_diff_suffix = re.compile(r'\s*(?:\[([^\[\]]*)\]|【([^【】]*)】|-([^-]+)-)\s*$')
+_separators = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """比較用に文字列を正規化する（全角・半角の統一、大文字・小文字の区別なし、空白・記号を除く）"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return _separators.sub('', text) or text.strip()
+
+
+def split_title(title):
+    """タイトルを (正規化したタイトル, 正規化した差分名) に分ける"""
+    title = unicodedata.normalize('NFKC', title)
+    m = _diff_suffix.search(title)
+    if not m or m.start() == 0:
+        return normalize(title), ''
+    return normalize(title[:m.start()]), normalize(next(g for g in m.groups() if g is not None))
+
+
+class TitleMatcher():
+    """ハッシュが一致しない譜面（ファイルを保存し直したものなど）を、タイトル・アーティストで songdata から探す
+
+    正規化はタイトル・アーティストの異なる値ごとに一度だけ行う。
+    候補は正規化したタイトルが同じ曲（なければ先頭 PREFIX_LENGTH 文字が同じ曲）に絞ってから比べる。
+    両方に差分名があり、それが似ていない（DIFF_MATCH_SCORE 未満の）曲は候補としない
+    """
+
+    def __init__(self, df_songdata):
+        self.df_songdata = df_songdata
+
+        # songdata の title, subtitle, artist はカテゴリなので、カテゴリ（異なる値）ごとに正規化する
+        title_split = [split_title(t) for t in df_songdata['title'].cat.categories]
+        keys = _row_values(df_songdata['title'], [key for key, _ in title_split])
+        diffs = _row_values(df_songdata['title'], [diff for _, diff in title_split])
+        subtitles = _row_values(df_songdata['subtitle'], [normalize(s) for s in df_songdata['subtitle'].cat.categories])
+        self.artists = _row_values(df_songdata['artist'], [normalize(a) for a in df_songdata['artist'].cat.categories])
+
+        # 差分名はサブタイトルにあればそちら、なければタイトル末尾の [...] など
+        self.diffs = np.where(subtitles != '', subtitles, diffs)
+
+        # 正規化したタイトルごとの行（ブロック）
+        key_codes, self.keys = pd.factorize(pd.Series(keys, dtype=object))
+        self.order = np.argsort(key_codes, kind='stable')
+        self.starts = np.searchsorted(key_codes[self.order], np.arange(len(self.keys) + 1))
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
+        self.key_lengths = np.fromiter((len(key) for key in self.keys), dtype=np.int64, count=len(self.keys))
+
+        self.prefix_index = {}
+        for i, key in enumerate(self.keys):
+            self.prefix_index.setdefault(key[:PREFIX_LENGTH], []).append(i)
+
+    def match(self, titles, artists):
+        """各譜面（タイトル, アーティスト）に最もよく似た songdata の行位置と類似度（0〜1）の配列を返す
+
+        候補がなければ行位置は -1、類似度は 0 となる
+        """
+        # 同じ (タイトル, アーティスト) は一度だけ探す
+        titles = pd.Series(titles, dtype=object).fillna('').astype(str).astype(object).reset_index(drop=True)
+        artists = pd.Series(artists, dtype=object).fillna('').astype(str).astype(object).reset_index(drop=True)
+        codes, uniques = pd.factorize(titles + '\x1f' + artists)
+
+        rows = np.full(len(uniques), -1, dtype=np.int64)
+        scores = np.zeros(len(uniques))
+        for code, pair in enumerate(uniques):
+            title, artist = pair.split('\x1f', 1)
+            rows[code], scores[code] = self._match_one(*split_title(title), normalize(artist))
+
+        return rows[codes], scores[codes]
+
+    def _match_one(self, key, diff, artist):
+        if not key:
+            return -1, 0.0
+
+        if key in self.key_index:
+            candidates = [(self.key_index[key], 1.0)]
+        else:
+            candidates = [(i, _similarity(key, self.keys[i])) for i in self._prefix_candidates(key)]
+
+        best_row, best_score = -1, 0.0
+        title_weight, artist_weight, diff_weight = SCORE_WEIGHTS
+        for key_code, title_score in candidates:
+            # 最高の類似度でも今の最良を超えないブロックは比べない
+            if title_weight * title_score + artist_weight + diff_weight <= best_score:
+                continue
+
+            for row in self.order[self.starts[key_code]:self.starts[key_code + 1]]:
+                diff_score = _similarity(diff, self.diffs[row])
+                if diff and self.diffs[row] and diff_score < DIFF_MATCH_SCORE:
+                    continue
+
+                score = (title_weight * title_score
+                         + artist_weight * _similarity(artist, self.artists[row])
+                         + diff_weight * diff_score)
+                if score > best_score:
+                    best_row, best_score = row, score
+
+        return best_row, best_score
+
+    def _prefix_candidates(self, key):
+        """先頭 PREFIX_LENGTH 文字が key と同じタイトル（のコード）を、長さの近い順に MAX_PREFIX_CANDIDATES 個まで返す"""
+        key_codes = self.prefix_index.get(key[:PREFIX_LENGTH], [])
+        if len(key_codes) > MAX_PREFIX_CANDIDATES:
+            # 長さの差が大きいほど類似度の上限（2 * 短いほうの長さ / 長さの和）は低い
+            key_codes = np.array(key_codes, dtype=np.int64)
+            length_diffs = np.abs(self.key_lengths[key_codes] - len(key))
+            key_codes = key_codes[np.argsort(length_diffs, kind='stable')[:MAX_PREFIX_CANDIDATES]]
+        return key_codes
+
+    def paths(self, rows):
+        """行位置の配列に対応する格納パスの配列を返す"""
+        return songdata.song_paths(self.df_songdata.iloc[rows])
+
+
+def find_probably_owned(matcher, df_table):
+    """未所持（found が偽）の譜面について、タイトル・アーティストが似ている songdata の曲を探す。
+
+    列 probable_score（類似度。PROBABLY_OWNED_SCORE 未満なら 0）, probable_path（格納パス）を
+    df_table と同じ行の並びで返す
+    """
+    probable_score = np.zeros(len(df_table))
+    probable_path = np.full(len(df_table), '', dtype=object)
+
+    missing = np.flatnonzero(~df_table['found'].to_numpy(dtype=bool))
+    if len(missing) > 0 and 'title' in df_table.columns:
+        artists = df_table['artist'].iloc[missing] if 'artist' in df_table.columns else [''] * len(missing)
+        rows, scores = matcher.match(df_table['title'].iloc[missing], artists)
+
+        probable = scores >= PROBABLY_OWNED_SCORE
+        probable_score[missing[probable]] = scores[probable]
+        probable_path[missing[probable]] = matcher.paths(rows[probable])
+
+    return pd.DataFrame({'probable_score': probable_score, 'probable_path': probable_path}, index=df_table.index)
+
+
+def _row_values(column, category_values):
+    """カテゴリの列の各行に、カテゴリごとの値（category_values）を割り当てた配列を返す。NULL の行は ''"""
+    # NULL のコードは -1 なので、末尾に '' を足しておけばそのまま引ける（カテゴリが空でもよい）
+    values = np.array(list(category_values) + [''], dtype=object)
+    return values[column.cat.codes.to_numpy()]
+
+
+def _similarity(a, b):
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    return SequenceMatcher(None, a, b, autojunk=False).ratio()
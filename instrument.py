@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import logging
+import threading
+import tracemalloc
+import cProfile
+import pstats
+from contextlib import contextmanager
+
+logger = logging.getLogger('bms-table-view')
+
+_trace_file = None
+_trace_lock = threading.Lock()
+_local = threading.local()
+
+
+def configure(log_level='INFO', log_file=None, trace_file=None):
+    """ログの出力先を設定する。
+
+    ログは標準出力に（log_file を指定するとファイルにも）出力する。
+    trace_file を指定すると、各区間を Chrome Trace Event 形式で書き出す
+    （chrome://tracing や https://ui.perfetto.dev で開ける）。
+    再度呼ぶと前の設定を置き換える（fork したワーカープロセスが親から引き継いだ設定など）
+    """
+    global _trace_file
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        if isinstance(handler, logging.FileHandler):
+            handler.close()
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+            _trace_file = None
+
+    logger.setLevel(log_level)
+    logger.propagate = False
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(stream_handler)
+
+    if log_file:
+        file_handler = logging.FileHandler(log_file, encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s] %(message)s'))
+        logger.addHandler(file_handler)
+
+    if trace_file:
+        # 配列の閉じ括弧は省略できる形式なので、終了時の処理は不要
+        with _trace_lock:
+            _trace_file = open(trace_file, 'wt', encoding='utf-8')
+            _trace_file.write('[\n')
+
+
+def event(message, **fields):
+    """進捗などのメッセージを記録する"""
+    logger.info(_format(message, fields))
+
+
+class Span():
+    """名前付きの区間。所要時間と、set() で追加した値（行数、バイト数、キャッシュの有無など）を記録する"""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = dict(fields)
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = _span_stack()
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _span_stack().pop()
+
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+
+        logger.info(_format(f'{"  " * self.depth}{self.name} {duration * 1000:.1f} ms', self.fields))
+        _write_trace_event(self.name, self.start, duration, self.fields)
+        return False
+
+
+def span(name, **fields):
+    """with span('区間名', key=value) as s: ... の形で区間の所要時間を記録する"""
+    return Span(name, fields)
+
+
+@contextmanager
+def profile(enabled, out_prefix='profile'):
+    """enabled が真なら、ブロック内の処理を cProfile と tracemalloc で計測する。
+
+    cProfile の結果は {out_prefix}.prof に保存し（snakeviz などで開ける）、
+    所要時間・メモリ確保量の上位をログに出力する
+    """
+    if not enabled:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(f'{out_prefix}.prof')
+        logger.info(f'プロファイル結果を {os.path.abspath(out_prefix)}.prof に保存')
+
+        stats = pstats.Stats(profiler)
+        stats.sort_stats('cumulative')
+        for func, (_, ncalls, _, cumtime, _) in sorted(stats.stats.items(), key=lambda item: -item[1][3])[:20]:
+            filename, lineno, funcname = func
+            logger.info(f'{cumtime * 1000:10.1f} ms {ncalls:8d} calls  {funcname} ({os.path.basename(filename)}:{lineno})')
+
+        logger.info(f'メモリ確保量のピーク: {peak / 1024 / 1024:.1f} MiB')
+        for stat in snapshot.statistics('lineno')[:10]:
+            logger.info(f'{stat.size / 1024 / 1024:10.1f} MiB  {stat.traceback}')
+
+
+def _span_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _format(message, fields):
+    if not fields:
+        return message
+    return f'{message} ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+
+
+def _write_trace_event(name, start, duration, fields):
+    if _trace_file is None:
+        return
+
+    trace_event = {
+        'name': name,
+        'ph': 'X',
+        'ts': start * 1e6,
+        'dur': duration * 1e6,
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        'args': fields,
+    }
+    with _trace_lock:
+        _trace_file.write(json.dumps(trace_event, ensure_ascii=False, default=str) + ',\n')
+        _trace_file.flush()
@@ -0,0 +1,143 @@
+import os
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+import songdata
+
+
+# ライブラリ分析に使う難易度表データの列
+TABLE_COLUMNS = ['md5', 'sha256']
+
+# フォルダのサイズを調べるとき、進捗を通知する間隔（フォルダ数）
+SIZE_PROGRESS_INTERVAL = 1000
+
+# analyze_library() の結果
+# - df_duplicates: 重複所持している譜面。1 行が 1 つの格納パスで、同じ譜面の行は group が同じ
+#                  （列 group, key, hash, title, artist, dir, file）
+# - df_folders: フォルダごとの集計（列 dir, charts, table_charts, duplicate_charts, size）
+LibraryAnalysis = namedtuple('LibraryAnalysis', ['df_duplicates', 'df_folders'])
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+def analyze_library(df_songdata, tables, with_size=True, progress=None, cancel_event=None):
+    """songdata 全体を分析し、重複所持している譜面と、フォルダごとの集計を求める。
+
+    tables には難易度表データ（md5, sha256 の列を持つ DataFrame）のリストを指定する。
+    譜面は md5 で（md5 がない譜面は sha256 で）同一かどうかを判定する。
+    フォルダごとに、譜面数、いずれかの難易度表に載っている譜面数、重複所持している譜面数、
+    with_size が真ならディスク上のサイズ（バイト、フォルダがなければ NaN）を求める
+    """
+    codes = df_songdata['dir'].cat.codes.to_numpy()
+    dir_names = df_songdata['dir'].cat.categories.to_numpy(dtype=object)
+
+    md5 = songdata.hash_bytes(df_songdata, 'md5')
+    sha256 = songdata.hash_bytes(df_songdata, 'sha256')
+
+    # 重複所持
+    duplicate_frames = []
+    duplicated = np.zeros(len(df_songdata), dtype=bool)
+    group_offset = 0
+    for key, hashes, candidates in (('md5', md5, md5 != b''), ('sha256', sha256, (md5 == b'') & (sha256 != b''))):
+        rows, groups = _duplicate_rows(hashes, candidates)
+        duplicated[rows] = True
+
+        df = df_songdata.iloc[rows]
+        duplicate_frames.append(pd.DataFrame({
+            'group': groups + group_offset,
+            'key': key,
+            'hash': songdata.hash_hex(df, key),
+            'title': songdata.title_inc_sub(df),
+            'artist': df['artist'].to_numpy(dtype=object),
+            'dir': df['dir'].to_numpy(dtype=object),
+            'file': df['file'].to_numpy(dtype=object),
+        }))
+        group_offset += groups.max() + 1 if len(groups) else 0
+    df_duplicates = pd.concat(duplicate_frames, ignore_index=True)
+
+    _check_cancelled(cancel_event)
+
+    # 難易度表に載っている譜面
+    in_table = np.zeros(len(df_songdata), dtype=bool)
+    for key, hashes in (('md5', md5), ('sha256', sha256)):
+        table_hashes = _table_hashes(tables, key)
+        in_table |= (hashes != b'') & np.isin(hashes, table_hashes)
+
+    # フォルダごとの集計
+    n_dirs = len(dir_names)
+    charts = np.bincount(codes, minlength=n_dirs)
+    df_folders = pd.DataFrame({
+        'dir': dir_names,
+        'charts': charts,
+        'table_charts': np.bincount(codes[in_table], minlength=n_dirs),
+        'duplicate_charts': np.bincount(codes[duplicated], minlength=n_dirs),
+    })
+    df_folders = df_folders[charts > 0].sort_values('dir', kind='stable').reset_index(drop=True)
+
+    if with_size:
+        df_folders['size'] = folder_sizes(df_folders['dir'], progress, cancel_event)
+
+    return LibraryAnalysis(df_duplicates, df_folders)
+
+
+def folder_sizes(dirs, progress=None, cancel_event=None):
+    """各フォルダ（サブフォルダを含む）のファイルサイズの合計（バイト）の配列を返す。存在しないフォルダは NaN"""
+    sizes = np.full(len(dirs), np.nan)
+    for i, dir_path in enumerate(dirs):
+        if i % SIZE_PROGRESS_INTERVAL == 0:
+            _check_cancelled(cancel_event)
+            if progress:
+                progress(f'フォルダのサイズを確認中 ({i}/{len(dirs)})')
+        sizes[i] = _folder_size(dir_path)
+    return sizes
+
+
+def _duplicate_rows(hashes, candidates):
+    """candidates の行のうち、ハッシュが他の行と同じ行の位置と、ハッシュごとの番号（group）を返す
+
+    group はハッシュの昇順、同じ group の中では songdata 上の順に並ぶ
+    """
+    rows = np.flatnonzero(candidates)
+    _, inverse, counts = np.unique(hashes[rows], return_inverse=True, return_counts=True)
+    duplicated = counts[inverse] > 1
+
+    rows, groups = rows[duplicated], inverse[duplicated]
+    order = np.lexsort((rows, groups))
+    _, groups = np.unique(groups[order], return_inverse=True)
+    return rows[order], groups
+
+
+def _table_hashes(tables, key):
+    # 難易度表のハッシュ（重複・空・不正な値を除く）
+    if not tables:
+        return np.zeros(0, dtype=f'S{songdata.HASH_BYTES[key]}')
+
+    hashes = np.unique(np.concatenate([songdata.hex_to_hash_bytes(df_table[key], key) for df_table in tables]))
+    return hashes[hashes != b'']
+
+
+def _folder_size(dir_path):
+    if not os.path.isdir(dir_path):
+        return np.nan
+
+    size = 0
+    stack = [dir_path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return size
+
+
+def _check_cancelled(cancel_event):
+    if cancel_event and cancel_event.is_set():
+        raise AnalysisCancelled()
@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+_Entry = namedtuple('_Entry', ['value', 'stamp', 'size'])
+
+
+class SizedLruCache():
+    """メモリ使用量（バイト数）の上限つき LRU キャッシュ
+
+    各要素は stamp（元データの状態を表す値）とともに保存し、
+    get() で渡した stamp と異なれば古いものとして捨てる。
+    上限を超えた場合は最も長く使われていない要素から捨てる（最後に追加した要素は上限を超えても残す）。
+    別スレッドから呼び出してよい
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, stamp):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            if entry.stamp != stamp:
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return entry.value
+
+    def put(self, key, value, stamp, size):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = _Entry(value, stamp, size)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.size
@@ -2,16 +2,19 @@ import os
 import re
 import sys
 import json
-import numpy as np
+import argparse
+import multiprocessing
 import tkinter as tk
 import tkinter.ttk as ttk
+import tkinter.messagebox as messagebox
 from tksheet import Sheet
 import subprocess
 
 import tkwidgets
-import songdata
-import bmstable
+import tkworker
+import report
 import version
+import instrument
 
 
 # デフォルトの難易度表リスト
@@ -31,12 +34,25 @@ class MainWindow(tk.Tk):
     FONT_UI_TITLE = ('MS UI Gothic', 12, 'bold', 'underline')
     HEADERS = ['Level', 'Title', 'Artist', 'Found', 'index']
 
+    # 入力が止まってから検索を開始するまでの時間
+    SEARCH_DEBOUNCE_MS = 300
+    # 検索結果をツリービューに追加するとき、一度に追加するフォルダ数
+    SEARCH_TREE_BATCH_SIZE = 50
+    # songdata.db の変更を確認する間隔
+    SONGDATA_WATCH_INTERVAL_MS = 3000
+
     def __init__(self, table_list):
         tk.Tk.__init__(self)
 
         title = f'bms-table-view {version.VERSION}'
         self.title(title)
 
+        # table, song_search は start() で songdata.db を読み込むまで None
+        self.table_list = table_list
+        self.table = None
+        self.song_search = None
+        self.songdata_db_path = None
+
         self.geometry('800x700')
         self.grid_columnconfigure(0, weight=1)
         self.grid_rowconfigure(2, weight=1)
@@ -51,6 +67,26 @@ class MainWindow(tk.Tk):
         self.table_combobox.current(DEFAULT_TABLE_INDEX)
         self.table_combobox.bind('<<ComboboxSelected>>', self._on_table_combobox_selected)
 
+        self.button_ownership = ttk.Button(self.table_frame,
+                                           text='所持状況',
+                                           state=tk.DISABLED,
+                                           command=self._on_show_ownership)
+        self.ownership_window = None
+        self.ownership_task = None
+
+        self.button_library = ttk.Button(self.table_frame,
+                                         text='ライブラリ分析',
+                                         state=tk.DISABLED,
+                                         command=self._on_show_library)
+        self.library_window = None
+        self.library_task = None
+
+        self.button_refresh_all = ttk.Button(self.table_frame,
+                                             text='すべて更新',
+                                             state=tk.DISABLED,
+                                             command=self._on_refresh_all)
+        self.refresh_task = None
+
         self.sheet = Sheet(self.table_frame,
                            headers=self.HEADERS,
                            font=self.FONT_UI,
@@ -69,6 +105,14 @@ class MainWindow(tk.Tk):
                                             text='未所持のみ表示',
                                             command=self._on_check_only_notfound)
 
+        self.label_status = tk.Label(self.table_frame, font=self.FONT_UI, fg='gray')
+        self.load_task = None
+        self.probable_task = None
+
+        # 表示中の難易度表（難易度表を読み込むまでは空）
+        self.df_table_view = self.row_details = None
+        self.not_found_rows = []
+
         self.info_frame = tk.Frame(self, bd=1, relief=tk.SOLID)
 
         self.label_title = tkwidgets.ClickableLabel(parent=self.info_frame, font=self.FONT_UI_TITLE)
@@ -79,23 +123,30 @@ class MainWindow(tk.Tk):
 
         self.label_urlpack = tkwidgets.ClickableLabel(parent=self.info_frame, font=self.FONT_UI)
 
+        self.label_probable = tkwidgets.ClickableLabel(parent=self.info_frame, font=self.FONT_UI)
+
         self.search_frame = tk.Frame(self)
         self.search_frame.grid_columnconfigure(0, weight=1)
         self.search_frame.grid_rowconfigure(2, weight=1)
 
         self.textbox_search = tkwidgets.TextBox(parent=self.search_frame, font=self.FONT_UI)
         self.textbox_search.get().bind('<Return>', self._search_songs)
+        self.textbox_search.set_change_event(self._on_search_condition_changed)
+        self.search_debouncer = tkworker.Debouncer(self, self.SEARCH_DEBOUNCE_MS, self._start_search)
+        self.search_task = None
+        self.last_search = None
+        self.treeview_fill_after_id = None
 
         self.search_option_frame = tk.Frame(self.search_frame)
 
         self.check_use_re = tkwidgets.CheckBox(parent=self.search_option_frame,
                                                text='正規表現',
-                                               command=None)
+                                               command=self._on_search_condition_changed)
         self.check_use_re.set_value(False)
 
         self.check_case_sensitive = tkwidgets.CheckBox(parent=self.search_option_frame,
                                                        text='大文字と小文字を区別',
-                                                       command=None)
+                                                       command=self._on_search_condition_changed)
         self.check_case_sensitive.set_value(False)
 
         self.treeview_frame = tk.Frame(self.search_frame)
@@ -123,14 +174,19 @@ class MainWindow(tk.Tk):
 
         # フレーム内 (table_frame)
         self.table_combobox.grid(row=0, column=0, sticky='ew', padx=4, pady=2)
-        self.sheet.grid(row=1, column=0, sticky='ew', padx=4, pady=2)
+        self.button_ownership.grid(row=0, column=1, sticky='e', padx=4, pady=2)
+        self.button_library.grid(row=0, column=2, sticky='e', padx=4, pady=2)
+        self.button_refresh_all.grid(row=0, column=3, sticky='e', padx=4, pady=2)
+        self.sheet.grid(row=1, column=0, columnspan=4, sticky='ew', padx=4, pady=2)
         self.check_only_notfound.get().grid(row=2, column=0, sticky='w')
+        self.label_status.grid(row=2, column=0, columnspan=4, sticky='e', padx=4)
 
         # フレーム内 (info_frame)
         self.label_title.get().grid(row=1, column=0, sticky='w', padx=4, pady=2)
         self.label_url.get().grid(row=2, column=0, sticky='w', padx=4, pady=2)
         self.label_urldiff.get().grid(row=3, column=0, sticky='w', padx=4, pady=2)
         self.label_urlpack.get().grid(row=4, column=0, sticky='w', padx=4, pady=2)
+        self.label_probable.get().grid(row=5, column=0, sticky='w', padx=4, pady=2)
 
         # フレーム内 (search_frame)
         self.textbox_search.get().grid(row=0, column=0, sticky='ew', padx=4, pady=2, ipadx=2, ipady=2)
@@ -149,73 +205,412 @@ class MainWindow(tk.Tk):
         style.configure("Treeview", font=self.FONT_UI)
         style.configure("TCheckbutton", font=self.FONT_UI)
 
-    def set_songdata(self, df_songdata):
+    def start(self, songdata_db_path):
+        """songdata.db を別スレッドで読み込む（ウィンドウはその間も操作できる）。
+
+        読み込めたら、難易度表の読み込みと songdata.db の監視を始める。
+        pandas などの重いモジュールもここで初めて読み込むので、ウィンドウはすぐに表示される
+        """
+        def load(progress, cancel_event):
+            import songdata
+            import songsearch
+            import bmstable
+            df_songdata = songdata.read_songdata(songdata_db_path)
+            table = bmstable.BmsTable(self.table_list, df_songdata)
+            with instrument.span('build_search_index', rows=len(df_songdata)):
+                song_search = songsearch.SongSearchIndex(df_songdata)
+            return df_songdata, table, song_search
+
+        self.songdata_db_path = songdata_db_path
+        self._set_status('songdata.db を読み込み中...')
+        self.start_task = tkworker.BackgroundTask(
+            self,
+            load,
+            on_done=lambda result: self._on_started(songdata_db_path, *result),
+            on_error=lambda e: self._set_status(f'songdata.db の読み込みに失敗しました: {e}')).start()
+
+    def _on_started(self, songdata_db_path, df_songdata, table, song_search):
+        self.set_songdata(df_songdata, song_search)
+        self.set_table(table)
+        self.watch_songdata(songdata_db_path)
+
+        for button in [self.button_ownership, self.button_library, self.button_refresh_all]:
+            button.configure(state=tk.NORMAL)
+
+        # 読み込み中に入力された検索語があれば検索する
+        if self.textbox_search.get_text():
+            self._start_search()
+
+    def set_songdata(self, df_songdata, song_search=None):
         self.df_songdata = df_songdata
+        if song_search is None:
+            import songsearch
+            with instrument.span('build_search_index', rows=len(df_songdata)):
+                song_search = songsearch.SongSearchIndex(df_songdata)
+        self.song_search = song_search
+        self.last_search = None
+
+        self._refresh_ownership()
+        self._refresh_library()
+
+    def watch_songdata(self, songdata_db_path):
+        """songdata.db の変更を監視し、変更されたら songdata を読み込み直す"""
+        self.songdata_db_path = songdata_db_path
+        self.songdata_task = None
+        self.songdata_reload_pending = False
+        self.songdata_watcher = tkworker.FileWatcher(self, songdata_db_path, self.SONGDATA_WATCH_INTERVAL_MS,
+                                                     self._reload_songdata).start()
+
+    def _reload_songdata(self):
+        """songdata.db の差分を別スレッドで読み込み、索引も作り直してから入れ替える"""
+        if self.songdata_task and self.songdata_task.running():
+            # 読み込み中に再び変更された場合は、終わってからもう一度読み込む
+            self.songdata_reload_pending = True
+            return
+
+        df_songdata = self.df_songdata
+        songdata_db_path = self.songdata_db_path
+        table = self.table
+        loaded = table.current_loaded()
+
+        def reload(progress, cancel_event):
+            import songdata
+            import songindex
+            import songsearch
+            import fuzzymatch
+            df, delta = songdata.reload_songdata(songdata_db_path, df_songdata)
+            if delta.empty():
+                return df, delta, None, None, None, None
+
+            # 現在の難易度表のマージし直し・「たぶん所持」の検索もここで済ませ、メインスレッドでは入れ替えるだけにする
+            song_index = songindex.SongIndex(df)
+            title_matcher = fuzzymatch.TitleMatcher(df)
+            merged = table.merge_songdata_delta(loaded, delta, song_index, title_matcher) if loaded else None
+            return df, delta, song_index, songsearch.SongSearchIndex(df), title_matcher, merged
+
+        self._set_status('songdata.db を再読み込み中...')
+        self.songdata_task = tkworker.BackgroundTask(
+            self,
+            reload,
+            on_done=self._on_songdata_reloaded,
+            on_error=self._on_songdata_reload_error).start()
+
+    def _on_songdata_reloaded(self, result):
+        df, delta, song_index, song_search, title_matcher, loaded = result
+        self._set_status('')
+
+        if not delta.empty():
+            if not self.table.update_songdata(df, delta, song_index, title_matcher, loaded):
+                # 再読み込み中に難易度表が切り替わった → 新しい songdata で読み込み直す
+                self._load_table(self.table_combobox.current())
+            elif self.df_table_view is not None:
+                self.df_table_view = self.table.get_table_view()
+                self.row_details = self.table.get_row_details()
+                self._refresh_sheet()
+            self.set_songdata(df, song_search)
+            self._set_status(f'songdata.db を再読み込みしました（追加 {len(delta.df_inserted)}, 削除 {len(delta.df_deleted)}）')
+
+            # 検索結果も新しい songdata で作り直す
+            if self.textbox_search.get_text():
+                self._start_search()
+
+        self._reload_songdata_if_pending()
+
+    def _on_songdata_reload_error(self, e):
+        self._set_status(f'songdata.db の再読み込みに失敗しました: {e}')
+        self._reload_songdata_if_pending()
+
+    def _reload_songdata_if_pending(self):
+        if self.songdata_reload_pending:
+            self.songdata_reload_pending = False
+            self._reload_songdata()
 
     def set_table(self, table):
-        self.table = table
-        self._make_table_for_view()
+        """難易度表を設定し、選択中の難易度表を読み込む。
 
-        # シートに曲リストを表示
-        self._update_sheet(show_only_notfound=True)
+        ウィンドウの表示を待たせないよう、読み込みは別スレッドで行う
+        """
+        self.table = table
+        self.df_table_view = table.get_table_view()
+        self.row_details = table.get_row_details()
+        self._load_table(self.table_combobox.current())
 
     def _on_table_combobox_selected(self, event):
-        index = self.table_combobox.current()
-        self.table.load(index)
-        self._make_table_for_view()
+        # songdata.db の読み込み中なら、読み込み後に選択中の難易度表を読み込む（set_table）
+        if self.table is None:
+            return
 
-        # シートに曲リストを表示
-        self._update_sheet(show_only_notfound=self.check_only_notfound.get_value())
+        index = self.table_combobox.current()
+        self._load_table(index)
 
-    def _make_table_for_view(self):
-        """シート表示用の譜面リスト（df_table_view）を作成する。
+    def _load_table(self, index):
+        """難易度表を別スレッドで読み込む。読み込み中の古い難易度表はキャンセルする
 
-        - 重複の削除（'index'(難易度表上の並び順)による）
-        - 難易度表ヘッダに 'level_order' の指定がある場合は並び替え
+        まず通信せずにキャッシュから読み込んで表示し、キャッシュがないか有効期間が過ぎていれば、
+        続けてダウンロード・更新の確認を行う（_update_table）
+        """
+        if self.load_task:
+            self.load_task.cancel()
+        if self.probable_task:
+            self.probable_task.cancel()
+
+        self._set_status('読み込み中...')
+        self.load_task = tkworker.BackgroundTask(
+            self,
+            lambda progress, cancel_event: self.table.fetch(index, progress, cancel_event, offline=True),
+            on_done=lambda loaded: self._on_cached_table_loaded(index, loaded),
+            on_error=self._on_table_load_error,
+            on_progress=self._set_status).start()
+
+    def _on_cached_table_loaded(self, index, loaded):
+        if loaded:
+            self._on_table_loaded(loaded)
+        else:
+            self._show_placeholder()
+
+        if loaded is None or self.table.needs_update(index):
+            self._update_table(index)
+
+    def _update_table(self, index):
+        """難易度表をダウンロード（キャッシュがあれば更新を確認）して表示し直す"""
+        self.load_task = tkworker.BackgroundTask(
+            self,
+            lambda progress, cancel_event: self.table.fetch(index, progress, cancel_event),
+            on_done=lambda loaded: self._on_table_loaded(loaded, keep_view=True),
+            on_error=self._on_table_update_error,
+            on_progress=self._set_status).start()
+
+    def _on_table_loaded(self, loaded, keep_view=False):
+        """keep_view が真で、表示中の難易度表と同じなら、選択中の行・スクロール位置はそのままにする
+
+        表示してから、「たぶん所持」を別スレッドで探す（_load_probable）
         """
-        df = self.table.get_table().drop_duplicates(subset='index')
+        # 読み込み中に songdata が更新されていたら、（メインスレッドでマージし直さず）読み込み直す
+        if self.table.is_stale(loaded):
+            self._load_table(loaded.table_index)
+            return
 
-        if 'level_order' in self.table.get_header().keys():
-            level_order = {str(x): i for i, x in enumerate(self.table.get_header()['level_order'])}
-            df = df.sort_values('level', key=lambda col: col.map(level_order), kind='stable')
+        keep_view = keep_view and self.table.current_index() == loaded.table_index
+        self.table.set_loaded(loaded)
+        self.df_table_view = self.table.get_table_view()
+        self.row_details = self.table.get_row_details()
 
-        self.df_table_view = df
+        # シートに曲リストを表示
+        if keep_view:
+            self._refresh_sheet()
+        else:
+            self._update_sheet(show_only_notfound=self.check_only_notfound.get_value())
+        self._set_status('')
+
+        # 初めてダウンロードした難易度表があれば所持状況に加わる
+        self._refresh_ownership()
+
+        self._load_probable(loaded)
+
+    def _load_probable(self, loaded):
+        """ハッシュが一致しない曲について、タイトル・アーティストが似ている曲（たぶん所持）を別スレッドで探す"""
+        if self.probable_task:
+            self.probable_task.cancel()
+        if 'probable_score' in loaded.df_table.columns:
+            return
+
+        self.probable_task = tkworker.BackgroundTask(
+            self,
+            lambda progress, cancel_event: self.table.fetch_probable(loaded, progress, cancel_event),
+            on_done=self._on_probable_loaded,
+            on_error=lambda e: instrument.logger.warning(f'たぶん所持の検索に失敗しました: {e}')).start()
+
+    def _on_probable_loaded(self, loaded):
+        # 探している間に難易度表・songdata が変わっていれば捨てる
+        if loaded is None or self.df_table_view is None or not self.table.is_current(loaded):
+            return
+
+        self.table.set_loaded(loaded)
+        self.df_table_view = self.table.get_table_view()
+        self.row_details = self.table.get_row_details()
+        self._refresh_sheet()
+
+    def _show_placeholder(self):
+        """難易度表がまだない（ダウンロード中・失敗）ことを、空のシートとステータスで示す"""
+        self.df_table_view = None
+        self.row_details = None
+        self._update_sheet()
+        self._set_status('難易度表を取得中...')
+
+    def _on_table_load_error(self, e):
+        self._set_status(f'難易度表の読み込みに失敗しました: {e}')
+
+    def _on_table_update_error(self, e):
+        if self.df_table_view is None:
+            self._set_status(f'難易度表を取得できませんでした（難易度表を選び直すと再試行します）: {e}')
+        else:
+            self._set_status(f'難易度表の更新を確認できないので、キャッシュを表示しています: {e}')
+
+    def _on_refresh_all(self):
+        """すべての難易度表を別スレッドでダウンロードしてキャッシュを更新する"""
+        if self.refresh_task and self.refresh_task.running():
+            return
+
+        self.button_refresh_all.configure(state=tk.DISABLED)
+        self._set_status('難易度表を更新中...')
+        self.refresh_task = tkworker.BackgroundTask(
+            self,
+            self.table.refresh_all,
+            on_done=self._on_refresh_all_done,
+            on_error=self._on_refresh_all_error,
+            on_progress=self._set_status).start()
+
+    def _on_refresh_all_done(self, errors):
+        self.button_refresh_all.configure(state=tk.NORMAL)
+
+        # 更新されたキャッシュから現在の難易度表を読み込み直す
+        self._load_table(self.table_combobox.current())
+        self._refresh_ownership()
+        self._refresh_library()
+
+        if errors:
+            names = '\n'.join(self.table.table_list[i].get('name') for i in sorted(errors))
+            messagebox.showwarning(title='すべて更新', message=f'更新に失敗した難易度表があります：\n{names}')
+
+    def _on_refresh_all_error(self, e):
+        self.button_refresh_all.configure(state=tk.NORMAL)
+        self._set_status(f'難易度表の更新に失敗しました: {e}')
+
+    def _set_status(self, message):
+        self.label_status.configure(text=message)
+
+    def _on_show_ownership(self):
+        if self.ownership_window:
+            self.ownership_window.lift()
+            return
+
+        self.ownership_window = OwnershipWindow(self, self.table.table_list)
+        self.ownership_window.protocol('WM_DELETE_WINDOW', self._on_ownership_window_closed)
+        self._refresh_ownership()
+
+    def _on_ownership_window_closed(self):
+        if self.ownership_task:
+            self.ownership_task.cancel()
+        self.ownership_window.destroy()
+        self.ownership_window = None
+
+    def _refresh_ownership(self):
+        """所持状況のウィンドウが開いていれば、別スレッドで集計し直す"""
+        if not self.ownership_window:
+            return
+
+        if self.ownership_task:
+            self.ownership_task.cancel()
+
+        window = self.ownership_window
+        window.set_status('集計中...')
+        self.ownership_task = tkworker.BackgroundTask(
+            self,
+            self.table.ownership_summary,
+            on_done=lambda result: window.set_summary(*result),
+            on_error=lambda e: window.set_status(f'集計に失敗しました: {e}')).start()
+
+    def _on_show_library(self):
+        if self.library_window:
+            self.library_window.lift()
+            return
+
+        self.library_window = LibraryWindow(self)
+        self.library_window.protocol('WM_DELETE_WINDOW', self._on_library_window_closed)
+        self._refresh_library()
+
+    def _on_library_window_closed(self):
+        if self.library_task:
+            self.library_task.cancel()
+        self.library_window.destroy()
+        self.library_window = None
+
+    def _refresh_library(self):
+        """ライブラリ分析のウィンドウが開いていれば、別スレッドで分析し直す"""
+        if not self.library_window:
+            return
+
+        if self.library_task:
+            self.library_task.cancel()
+
+        window = self.library_window
+        window.set_status('分析中...')
+        self.library_task = tkworker.BackgroundTask(
+            self,
+            self.table.library_analysis,
+            on_progress=window.set_status,
+            on_done=lambda result: window.set_analysis(*result),
+            on_error=lambda e: window.set_status(f'分析に失敗しました: {e}')).start()
 
     def _update_sheet(self, show_only_notfound=False):
-        self._clear_sheet()
-
+        """df_table_view の内容でシートのデータを作り直す（df_table_view がなければ空にする）"""
+        import numpy as np
         df = self.df_table_view
-        for level, title, artist, found, index in zip(df['level'], df['title'], df['artist'], df['found'], df['index']):
-            found_str = '' if found else '未所持'
-            self.sheet.insert_row(values=(f'{self.table.get_header()["symbol"]}{level}', title, artist, found_str, index), idx='end')
-
-        not_found_rows = []
-        i_line_notfound = 0
-        for found in df['found']:
-            if not found:
-                not_found_rows += [i_line_notfound]
-            i_line_notfound += 1
-
-        self.sheet.dehighlight_all()
-        self.sheet.highlight_rows(not_found_rows, fg='blue')
-
+        if df is None:
+            self.not_found_rows = []
+            self.sheet.display_rows(None, all_rows_displayed=True)
+            self.sheet.dehighlight_all(redraw=False)
+            self.sheet.set_sheet_data([], redraw=True)
+            return
+
+        found = df['found'].to_numpy(dtype=bool)
+
+        with instrument.span('update_sheet', rows=len(df)):
+            # シートのデータを列単位で作り、まとめて設定する
+            found_str = np.where(found, '', '未所持')
+            if 'probable_score' in df.columns:
+                # ハッシュは一致しないが、タイトル・アーティストが似ている曲を所持している
+                probable = np.flatnonzero(~found & (df['probable_score'].to_numpy() > 0))
+                found_str = found_str.astype(object)
+                found_str[probable] = [f'たぶん所持 {score:.0%}' for score in df['probable_score'].to_numpy()[probable]]
+            columns = [df['level_label'], df['title'], df['artist'], found_str, df['index']]
+            data = np.column_stack([np.asarray(col, dtype=object) for col in columns]).tolist() if len(df) > 0 else []
+
+            self.not_found_rows = np.flatnonzero(~found).tolist()
+
+            self.sheet.display_rows(None, all_rows_displayed=True)
+            self.sheet.dehighlight_all(redraw=False)
+            self.sheet.set_sheet_data(data, redraw=False)
+            self._set_column_widths()
+            self.sheet.highlight_rows(self.not_found_rows, fg='blue', redraw=False)
+
+            self._display_rows(show_only_notfound)
+
+    def _refresh_sheet(self):
+        """シートを作り直す。選択中の行・スクロール位置はそのままにする"""
+        selected_rows = [self.sheet.displayed_row_to_data(r) for r in self.sheet.get_selected_rows()]
+        yview = self.sheet.get_yview()
+
+        show_only_notfound = self.check_only_notfound.get_value()
+        self._update_sheet(show_only_notfound=show_only_notfound)
+
+        self.sheet.set_yview(yview[0])
+        for data_row in selected_rows:
+            if not show_only_notfound:
+                self.sheet.select_row(data_row, redraw=False)
+            elif data_row in self.not_found_rows:
+                self.sheet.select_row(self.not_found_rows.index(data_row), redraw=False)
+        self.sheet.redraw()
+
+    def _display_rows(self, show_only_notfound):
+        """シートのデータはそのままで、表示する行だけを切り替える"""
         if show_only_notfound:
-            self.sheet.display_rows(not_found_rows, all_rows_displayed=False)
+            self.sheet.display_rows(self.not_found_rows, all_rows_displayed=False, redraw=True)
+        else:
+            self.sheet.display_rows(None, all_rows_displayed=True, redraw=True)
 
-        if len(not_found_rows) > 0:
+        if len(self.not_found_rows) > 0:
             self.sheet.select_row(0)
             self.sheet.see(row=0)
 
-    def _clear_sheet(self):
-        self.sheet.display_rows(None, all_rows_displayed=True)
-        self.sheet.set_sheet_data([])
+    def _set_column_widths(self):
         self.sheet.column_width(column=0, width=50)
         self.sheet.column_width(column=1, width=400)
         self.sheet.column_width(column=2, width=180)
-        self.sheet.column_width(column=3, width=80)
+        self.sheet.column_width(column=3, width=100)
 
     def _on_check_only_notfound(self):
-        self._update_sheet(show_only_notfound=self.check_only_notfound.get_value())
+        self._display_rows(show_only_notfound=self.check_only_notfound.get_value())
 
     def _sheet_select_event(self, event=None):
         if event[0] == 'select_cell':
@@ -229,49 +624,125 @@ class MainWindow(tk.Tk):
             # 表示されている行の番号から元データの行番号を得る（非表示の行がある場合を考慮）
             disp_row_idx = self.sheet.displayed_row_to_data(row_idx)
 
-            # 曲データを取得
-            row = self.df_table_view.iloc[disp_row_idx].replace(np.nan, '')
-            title = row['title']
-            md5 = row['md5']
-            ir_url = f'http://www.dream-pro.info/~lavalse/LR2IR/search.cgi?mode=ranking&bmsmd5={md5}' if md5 else ''
-            url = row['url'] if 'url' in row.keys() and row['url'] else ''
-            url_diff = row['url_diff'] if 'url_diff' in row.keys() and row['url_diff'] else ''
-            name_diff = f'- {row["name_diff"]}' if 'name_diff' in row.keys() and row['name_diff'] else ''
-
-            if 'url_pack' in self.df_table_view.columns:
-                url_pack = row['url_pack'] if 'url_pack' in row.keys() else ''
-                name_pack = f'- {row["name_pack"]}' if 'name_pack' in row.keys() and row['name_pack'] else ''
-            else:
-                url_pack, name_pack = '', ''
+            # 曲データ（表示用の文字列は読み込み時に作成済み）を取得
+            detail = self.row_details[disp_row_idx]
 
             # 曲データをUIに反映
-            self.label_title.set_text(title)
-            self.label_title.set_click_event(ir_url)
+            self.label_title.set_text(detail.title)
+            self.label_title.set_click_event(detail.ir_url)
 
-            self.label_url.set_text(url)
-            self.label_url.set_click_event(url)
+            self.label_url.set_text(detail.url)
+            self.label_url.set_click_event(detail.url)
 
-            self.label_urldiff.set_text(f'{url_diff} {name_diff}')
-            self.label_urldiff.set_click_event(url_diff)
+            self.label_urldiff.set_text(detail.url_diff_text)
+            self.label_urldiff.set_click_event(detail.url_diff)
 
-            if url_pack:
-                self.label_urlpack.set_text(f'{url_pack} {name_pack}')
-                self.label_urlpack.set_click_event(url_pack)
+            if detail.url_pack:
+                self.label_urlpack.set_text(detail.url_pack_text)
+                self.label_urlpack.set_click_event(detail.url_pack)
             else:
                 self.label_urlpack.set_text('')
 
-            self.textbox_search.set_text(re.sub(r'\s*\[.[^\[]+\]$', '', title))
+            # たぶん所持している曲の格納パス（クリックでフォルダを開く）
+            self.label_probable.set_text(detail.probable_text)
+            self.label_probable.set_click_command(lambda: self._open_folder(detail.probable_dir))
+
+            self.textbox_search.set_text(detail.search_text)
+
+    def _on_search_condition_changed(self):
+        # 入力中は検索せず、入力が止まってから検索する
+        self.search_debouncer.trigger()
 
     def _search_songs(self, event):
-        # テキストボックスの内容で曲を検索
+        self.search_debouncer.cancel()
+        self._start_search()
+
+    def _start_search(self):
+        """テキストボックスの内容で曲を別スレッドで検索する。実行中の古い検索はキャンセルする"""
         search_word = self.textbox_search.get_text()
         use_re = self.check_use_re.get_value()
         case_sensitive = self.check_case_sensitive.get_value()
-        df_result = self.df_songdata[self.df_songdata['title_inc_sub'].str.contains(search_word, case=case_sensitive, regex=use_re)]
-        
+        query = (search_word, use_re, case_sensitive)
+
+        if self.search_task:
+            self.search_task.cancel()
+        self._cancel_treeview_fill()
+
+        if search_word == '':
+            self.last_search = None
+            self.treeview.delete(*self.treeview.get_children())
+            return
+
+        # songdata.db の読み込み中は songdata.db に直接問い合わせ、読み込み後に検索し直す（_on_started）
+        # 正規表現は SQLite で扱えないので、読み込み後にだけ検索する
+        if self.song_search is None:
+            if not use_re and self.songdata_db_path:
+                self._start_db_search(query)
+            return
+
+        # 検索中に songdata が入れ替わっても、検索に使ったものと結果を対応させる
+        candidates = self._search_candidates(query)
+        song_search = self.song_search
+        df_songdata = self.df_songdata
+        self.search_task = tkworker.BackgroundTask(
+            self,
+            lambda progress, cancel_event: song_search.search(search_word, use_re=use_re, case_sensitive=case_sensitive,
+                                                          candidates=candidates, cancel_event=cancel_event),
+            on_done=lambda rows: self._on_search_done(query, df_songdata, rows),
+            on_error=self._on_search_error).start()
+
+    def _start_db_search(self, query):
+        """songdata を読み込まずに、songdata.db に問い合わせて検索する（songdata.SongDataDb.search_titles）"""
+        search_word, _, case_sensitive = query
+        songdata_db_path = self.songdata_db_path
+
+        def search(progress, cancel_event):
+            import songdata
+            df = songdata.open_songdata_db(songdata_db_path).search_titles(search_word, case_sensitive)
+            titles = df['title'].fillna('') + ' ' + df['subtitle'].fillna('')
+            return list(zip(titles, df['artist'].fillna(''), df['path']))
+
+        self.search_task = tkworker.BackgroundTask(
+            self,
+            search,
+            on_done=self._show_search_results,
+            on_error=self._on_search_error).start()
+
+    def _search_candidates(self, query):
+        """前回の検索語を含む検索語であれば、前回の検索結果の中だけを検索すればよい"""
+        if self.last_search is None:
+            return None
+
+        (last_word, last_use_re, last_case_sensitive), last_rows = self.last_search
+        search_word, use_re, case_sensitive = query
+        if use_re or last_use_re or case_sensitive != last_case_sensitive:
+            return None
+
+        if case_sensitive:
+            extends_last = last_word in search_word
+        else:
+            extends_last = last_word.casefold() in search_word.casefold()
+
+        return last_rows if extends_last else None
+
+    def _on_search_error(self, e):
+        if isinstance(e, re.error):
+            self._set_status(f'正規表現が正しくありません: {e}')
+        else:
+            self._set_status(f'検索に失敗しました: {e}')
+
+    def _on_search_done(self, query, df_songdata, rows):
+        import songdata
+        if df_songdata is self.df_songdata:
+            self.last_search = (query, rows)
+        df_result = df_songdata.iloc[rows]
+        self._show_search_results(zip(songdata.title_inc_sub(df_result), df_result['artist'], songdata.song_paths(df_result)))
+
+    def _show_search_results(self, songs):
+        """検索結果（(タイトル, アーティスト, 格納パス) の並び）をツリービューに表示する"""
         # 検索結果：譜面格納フォルダのパスと、含まれる差分の一覧
         dirlist = {}
-        for title, artist, path in zip(df_result['title_inc_sub'], df_result['artist'], df_result['path']):
+        for title, artist, path in songs:
             path_dir = os.path.dirname(path)
             path_base = os.path.basename(path)
             diff_data = { 'title':title, 'artist':artist, 'diff':path_base }
@@ -283,31 +754,305 @@ class MainWindow(tk.Tk):
         
         # ツリービューに譜面格納フォルダのパス・差分一覧を表示
         self.treeview.delete(*self.treeview.get_children())
-        for path, diff_list in dirlist.items():
+        self._fill_treeview(list(dirlist.items()), 0)
+
+    def _fill_treeview(self, dir_items, start):
+        """検索結果を SEARCH_TREE_BATCH_SIZE フォルダずつツリービューに追加する
+
+        一度に全件を追加せず、残りは after() で次に回すので、件数が多くても UI が止まらない
+        """
+        end = start + self.SEARCH_TREE_BATCH_SIZE
+        for path, diff_list in dir_items[start:end]:
             iid = self.treeview.insert(parent='', index='end', text=path, open=True)
             for diff in diff_list:
                 self.treeview.insert(parent=iid, index='end', text=diff['title'], values=[diff['artist'], diff['diff']])
 
+        if end < len(dir_items):
+            self.treeview_fill_after_id = self.after(1, lambda: self._fill_treeview(dir_items, end))
+        else:
+            self.treeview_fill_after_id = None
+
+    def _cancel_treeview_fill(self):
+        if self.treeview_fill_after_id:
+            self.after_cancel(self.treeview_fill_after_id)
+            self.treeview_fill_after_id = None
+
     def _on_treeview_rclick(self, event):
         iid = self.treeview.identify_row(y=event.y)
         if self.treeview.parent(iid) != '':
             iid = self.treeview.parent(iid)
 
-        dir_path = self.treeview.item(iid)['text']
+        self._open_folder(self.treeview.item(iid)['text'])
+
+    def _open_folder(self, dir_path):
         if os.path.isdir(dir_path):
             subprocess.Popen(['explorer', dir_path], shell=True)
 
 
+class OwnershipWindow(tk.Toplevel):
+    """難易度表ごと・レベルごとの所持状況（所持・未所持の譜面数）を表示するウィンドウ"""
+    FONT_UI = MainWindow.FONT_UI
+
+    def __init__(self, master, table_list):
+        tk.Toplevel.__init__(self, master)
+        self.title('所持状況')
+        self.geometry('480x500')
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+
+        self.table_list = table_list
+
+        self.treeview = ttk.Treeview(master=self, columns=('owned', 'missing', 'total', 'rate'))
+        self.treeview.column('#0', width=200, stretch=1)
+        for column, text in [('owned', '所持'), ('missing', '未所持'), ('total', '合計'), ('rate', '所持率')]:
+            self.treeview.column(column, width=60, stretch=0, anchor='e')
+            self.treeview.heading(column, text=text)
+        self.treeview.heading('#0', text='難易度表/レベル')
+
+        self.vscrollbar = ttk.Scrollbar(self, orient="vertical", command=self.treeview.yview)
+        self.treeview.configure(yscrollcommand=self.vscrollbar.set)
+
+        self.label_status = tk.Label(self, font=self.FONT_UI, fg='gray', anchor='w')
+
+        self.treeview.grid(row=0, column=0, sticky=tk.NSEW, padx=4, pady=2)
+        self.vscrollbar.grid(row=0, column=1, sticky=tk.NSEW)
+        self.label_status.grid(row=1, column=0, columnspan=2, sticky='ew', padx=4)
+
+    def set_status(self, message):
+        self.label_status.configure(text=message)
+
+    def set_summary(self, df_summary, not_cached):
+        """ownership_summary() の結果を表示する。開いていた難易度表は開いたままにする"""
+        opened = {iid for iid in self.treeview.get_children() if self.treeview.item(iid, 'open')}
+        self.treeview.delete(*self.treeview.get_children())
+
+        for table_index, df in df_summary.groupby('table_index', sort=False):
+            iid = f'table{table_index}'
+            self.treeview.insert(parent='', index='end', iid=iid, open=iid in opened,
+                                 text=self.table_list[table_index].get('name'),
+                                 values=self._count_values(df['owned'].sum(), df['missing'].sum(), df['total'].sum()))
+            for row in df.itertuples():
+                self.treeview.insert(parent=iid, index='end', text=row.level_label,
+                                     values=self._count_values(row.owned, row.missing, row.total))
+
+        if not_cached:
+            names = ', '.join(self.table_list[i].get('name') for i in not_cached)
+            self.set_status(f'未取得の難易度表: {names}')
+        else:
+            self.set_status('')
+
+    def _count_values(self, owned, missing, total):
+        rate = f'{owned / total * 100:.1f}%' if total else ''
+        return [owned, missing, total, rate]
+
+
+class LibraryWindow(tk.Toplevel):
+    """ライブラリ分析（重複所持している譜面、フォルダごとの譜面数・サイズ）を表示するウィンドウ"""
+    FONT_UI = MainWindow.FONT_UI
+
+    # ツリービューに一度に追加する行数
+    TREE_BATCH_SIZE = 500
+
+    FOLDER_COLUMNS = [('charts', '譜面数'), ('table_charts', '難易度表'), ('duplicate_charts', '重複'), ('size', 'サイズ(MB)')]
+
+    def __init__(self, master):
+        tk.Toplevel.__init__(self, master)
+        self.title('ライブラリ分析')
+        self.geometry('720x560')
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+
+        self.analysis = None
+        self.fill_after_ids = {}
+        self.folder_sort = ('dir', False)
+
+        self.notebook = ttk.Notebook(self)
+
+        # 重複所持
+        self.duplicate_frame = tk.Frame(self.notebook)
+        self.duplicate_frame.grid_columnconfigure(0, weight=1)
+        self.duplicate_frame.grid_rowconfigure(0, weight=1)
+
+        self.duplicate_treeview = ttk.Treeview(master=self.duplicate_frame, columns=('artist', 'count'))
+        self.duplicate_treeview.column('#0', width=480, stretch=1)
+        self.duplicate_treeview.column('artist', width=140, stretch=0)
+        self.duplicate_treeview.column('count', width=50, stretch=0, anchor='e')
+        self.duplicate_treeview.heading('#0', text='Title/Path')
+        self.duplicate_treeview.heading('artist', text='Artist')
+        self.duplicate_treeview.heading('count', text='数')
+        self.duplicate_treeview.bind('<3>', self._on_treeview_rclick)
+
+        self.duplicate_vscrollbar = ttk.Scrollbar(self.duplicate_frame, orient="vertical", command=self.duplicate_treeview.yview)
+        self.duplicate_treeview.configure(yscrollcommand=self.duplicate_vscrollbar.set)
+
+        # フォルダ
+        self.folder_frame = tk.Frame(self.notebook)
+        self.folder_frame.grid_columnconfigure(0, weight=1)
+        self.folder_frame.grid_rowconfigure(1, weight=1)
+
+        self.check_only_untabled = tkwidgets.CheckBox(parent=self.folder_frame,
+                                                      text='どの難易度表にも載っていないフォルダのみ',
+                                                      command=self._show_folders)
+        self.check_only_untabled.set_value(False)
+
+        self.folder_treeview = ttk.Treeview(master=self.folder_frame, columns=[c for c, _ in self.FOLDER_COLUMNS])
+        self.folder_treeview.column('#0', width=360, stretch=1)
+        self.folder_treeview.heading('#0', text='フォルダ', command=lambda: self._sort_folders('dir'))
+        for column, text in self.FOLDER_COLUMNS:
+            self.folder_treeview.column(column, width=70, stretch=0, anchor='e')
+            self.folder_treeview.heading(column, text=text, command=lambda c=column: self._sort_folders(c))
+        self.folder_treeview.bind('<3>', self._on_treeview_rclick)
+
+        self.folder_vscrollbar = ttk.Scrollbar(self.folder_frame, orient="vertical", command=self.folder_treeview.yview)
+        self.folder_treeview.configure(yscrollcommand=self.folder_vscrollbar.set)
+
+        self.label_status = tk.Label(self, font=self.FONT_UI, fg='gray', anchor='w')
+
+        # レイアウト
+        self.notebook.add(self.duplicate_frame, text='重複所持')
+        self.notebook.add(self.folder_frame, text='フォルダ')
+        self.notebook.grid(row=0, column=0, sticky=tk.NSEW, padx=4, pady=2)
+        self.label_status.grid(row=1, column=0, sticky='ew', padx=4)
+
+        self.duplicate_treeview.grid(row=0, column=0, sticky=tk.NSEW, padx=4, pady=2)
+        self.duplicate_vscrollbar.grid(row=0, column=1, sticky=tk.NSEW)
+
+        self.check_only_untabled.get().grid(row=0, column=0, sticky='w')
+        self.folder_treeview.grid(row=1, column=0, sticky=tk.NSEW, padx=4, pady=2)
+        self.folder_vscrollbar.grid(row=1, column=1, sticky=tk.NSEW)
+
+    def set_status(self, message):
+        self.label_status.configure(text=message)
+
+    def set_analysis(self, analysis, not_cached):
+        """BmsTable.library_analysis() の結果を表示する"""
+        self.analysis = analysis
+        self._show_duplicates()
+        self._show_folders()
+
+        df_duplicates = analysis.df_duplicates
+        message = f'重複所持: {df_duplicates["group"].nunique()} 譜面 ({len(df_duplicates)} ファイル)'
+        if not_cached:
+            message += f' / 未取得の難易度表: {len(not_cached)}'
+        self.set_status(message)
+
+    def _show_duplicates(self):
+        # 同じ譜面（group）ごとに、格納パスを子として並べる
+        import numpy as np
+        df = self.analysis.df_duplicates
+        paths = (df['dir'] + df['file']).to_numpy(dtype=object)
+        groups = df['group'].to_numpy()
+        starts = np.flatnonzero(np.diff(groups, prepend=-1))
+        bounds = list(zip(starts, np.append(starts[1:], len(groups))))
+
+        def insert(treeview, start, end):
+            iid = treeview.insert(parent='', index='end', text=df['title'].iat[start],
+                                  values=[df['artist'].iat[start], end - start])
+            for path in paths[start:end]:
+                treeview.insert(parent=iid, index='end', text=path)
+
+        self._fill(self.duplicate_treeview, bounds, insert)
+
+    def _show_folders(self):
+        if self.analysis is None:
+            return
+
+        df = self.analysis.df_folders
+        if self.check_only_untabled.get_value():
+            df = df[df['table_charts'] == 0]
+        column, descending = self.folder_sort
+        if column in df.columns:
+            df = df.sort_values(column, ascending=not descending, kind='stable')
+
+        size_mb = (df['size'] / 1024 / 1024).map(lambda v: '' if v != v else f'{v:.1f}') if 'size' in df.columns else [''] * len(df)
+        rows = list(zip(df['dir'], df['charts'], df['table_charts'], df['duplicate_charts'], size_mb))
+
+        def insert(treeview, dir_path, *values):
+            treeview.insert(parent='', index='end', text=dir_path, values=values)
+
+        self._fill(self.folder_treeview, rows, insert)
+
+    def _sort_folders(self, column):
+        # 同じ列をもう一度クリックすると逆順
+        current, descending = self.folder_sort
+        self.folder_sort = (column, not descending if column == current else column != 'dir')
+        self._show_folders()
+
+    def _fill(self, treeview, items, insert):
+        """items を TREE_BATCH_SIZE 件ずつ treeview に追加する（残りは after() で次に回す）"""
+        if treeview in self.fill_after_ids:
+            self.after_cancel(self.fill_after_ids.pop(treeview))
+        treeview.delete(*treeview.get_children())
+
+        def fill(start):
+            end = start + self.TREE_BATCH_SIZE
+            for item in items[start:end]:
+                insert(treeview, *item)
+
+            if end < len(items):
+                self.fill_after_ids[treeview] = self.after(1, lambda: fill(end))
+            else:
+                self.fill_after_ids.pop(treeview, None)
+
+        fill(0)
+
+    def _on_treeview_rclick(self, event):
+        # 格納パス・フォルダをエクスプローラで開く
+        treeview = event.widget
+        iid = treeview.identify_row(y=event.y)
+        if not iid or treeview.get_children(iid):
+            return
+
+        dir_path = os.path.dirname(treeview.item(iid)['text']) if treeview is self.duplicate_treeview else treeview.item(iid)['text']
+        if os.path.isdir(dir_path):
+            subprocess.Popen(['explorer', dir_path], shell=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='未所持の BMS 譜面を導入するための個人用ツール')
+    parser.add_argument('--report', metavar='OUT_DIR',
+                        help='ウィンドウを表示せず、すべての難易度表の未所持譜面の一覧を OUT_DIR に書き出す')
+    parser.add_argument('--format', choices=report.REPORT_FORMATS, default='csv',
+                        help='--report の出力形式（デフォルト: csv）')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='--report で並列に処理するプロセス数（デフォルト: CPU コア数）')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='ログの出力レベル（デフォルト: INFO）')
+    parser.add_argument('--log-file', metavar='PATH', help='ログをファイルにも出力する')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='各処理段階の所要時間を Chrome Trace Event 形式（JSON）で書き出す')
+    parser.add_argument('--profile', action='store_true',
+                        help='終了時に cProfile・tracemalloc の計測結果を profile.prof とログに出力する')
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+
+    # 出力先はカレントフォルダからの相対パスとして解釈する
+    report_dir = os.path.abspath(args.report) if args.report else None
+    log_file = os.path.abspath(args.log_file) if args.log_file else None
+    trace_file = os.path.abspath(args.trace) if args.trace else None
+
     # スクリプトのあるフォルダに移動
     os.chdir(os.path.dirname(sys.argv[0]))
 
     # songdata.db のパスを読み込み
     config = json.load(open('config.json', 'r', encoding='utf-8'))
 
-    # songdata.db 読み込み
-    df_songdata = songdata.read_songdata(config['SONGDATA_DB_PATH'])
+    # ログ・計測の設定（コマンドライン引数が優先）
+    log_settings = {
+        'log_level': args.log_level or config.get('LOG_LEVEL', 'INFO'),
+        'log_file': log_file or config.get('LOG_FILE'),
+        'trace_file': trace_file or config.get('TRACE_FILE'),
+    }
+    instrument.configure(**log_settings)
+
+    with instrument.profile(args.profile or config.get('PROFILE', False)):
+        run(config, report_dir, args, log_settings)
+
 
+def run(config, report_dir, args, log_settings=None):
     # 難易度表リスト読み込み
     # 設定ファイルに記述がなければデフォルトのリストを使用
     table_list = []
@@ -317,17 +1062,23 @@ def main():
     if len(table_list) == 0:
         table_list = TABLE_LIST_DEFAULT
 
-    # 難易度表読み込み
-    # キャッシュがなければダウンロードする
-    table = bmstable.BmsTable(table_list, df_songdata)
-    table.load(DEFAULT_TABLE_INDEX)
+    # 未所持譜面レポートの書き出し（GUIなし）
+    if report_dir:
+        results = report.write_missing_reports(table_list, config['SONGDATA_DB_PATH'], report_dir, args.format, args.jobs,
+                                               config.get('SONGDATA_DB_IMMUTABLE', False), log_settings)
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            sys.exit(1)
+        return
 
     # GUI表示
+    # songdata.db・難易度表はウィンドウを表示してから別スレッドで読み込む（キャッシュがなければダウンロードする）
     main_window = MainWindow(table_list)
-    main_window.set_songdata(df_songdata)
-    main_window.set_table(table)
+    main_window.start(config['SONGDATA_DB_PATH'])
     main_window.mainloop()
 
 
 if __name__ == '__main__':
+    # PyInstaller でビルドした実行ファイルでワーカープロセスを使うために必要
+    multiprocessing.freeze_support()
     main()
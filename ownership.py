@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+
+# 所持状況の集計に使う難易度表データの列
+SUMMARY_COLUMNS = ['level', 'md5', 'sha256']
+
+
+def build_ownership_summary(tables, song_index):
+    """難易度表ごと・レベルごとに、所持・未所持の譜面数を集計する。
+
+    tables には (table_index, 難易度表ヘッダ, 難易度表データ) のリストを指定する。
+    複数の難易度表に載っている譜面も多いので、すべての難易度表の (md5, sha256) の組から
+    重複を除き、songdata の索引（SongIndex）はまとめて一度だけ引く。
+
+    列 table_index, level, level_label, total, owned, missing の DataFrame を返す。
+    行は難易度表の順、難易度表内では level_order（なければ登場順）の順に並ぶ
+    """
+    frames = []
+    for table_index, table_header, df_table in tables:
+        frames.append(pd.DataFrame({
+            'table_index': table_index,
+            'level': df_table['level'].map(str).to_numpy(dtype=object),
+            'level_label': (table_header.get('symbol', '') + df_table['level'].map(str)).to_numpy(dtype=object),
+            'level_rank': _level_rank(table_header, df_table['level']),
+            'md5': df_table['md5'].to_numpy(dtype=object),
+            'sha256': df_table['sha256'].to_numpy(dtype=object),
+        }))
+
+    if not frames:
+        return pd.DataFrame(columns=['table_index', 'level', 'level_label', 'total', 'owned', 'missing'])
+
+    df = pd.concat(frames, ignore_index=True)
+    df['owned'] = _owned(df['md5'], df['sha256'], song_index)
+
+    df_summary = (df.groupby(['table_index', 'level'], sort=False)
+                  .agg(level_label=('level_label', 'first'),
+                       level_rank=('level_rank', 'first'),
+                       total=('owned', 'size'),
+                       owned=('owned', 'sum'))
+                  .reset_index())
+    df_summary['owned'] = df_summary['owned'].astype(int)
+    df_summary['missing'] = df_summary['total'] - df_summary['owned']
+
+    df_summary = df_summary.sort_values(['table_index', 'level_rank'], kind='stable')
+    return df_summary.drop(columns='level_rank').reset_index(drop=True)
+
+
+def _owned(md5, sha256, song_index):
+    """各行の譜面を所持しているか。同じ (md5, sha256) の組は一度だけ索引を引く"""
+    keys = md5.fillna('').astype(object) + '\t' + sha256.fillna('').astype(object)
+    codes, uniques = pd.factorize(keys)
+    _, first = np.unique(codes, return_index=True)
+
+    owned_unique = song_index.find(md5.iloc[first], sha256.iloc[first]) >= 0
+    return owned_unique[codes]
+
+
+def _level_rank(table_header, levels):
+    # level_order にないレベルは後ろに回す（同じ順位の中では登場順）
+    level_order = {str(x): i for i, x in enumerate(table_header.get('level_order', []))}
+    return levels.map(str).map(level_order).fillna(len(level_order)).to_numpy()
@@ -0,0 +1,122 @@
+import os
+import re
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import instrument
+
+
+# 未所持譜面レポートに出力する列
+REPORT_COLUMNS = ['level', 'title', 'artist', 'url', 'url_diff', 'md5', 'sha256']
+
+REPORT_FORMATS = ['csv', 'json']
+
+# ワーカープロセスごとの BmsTable（_init_worker で作成）
+_worker_table = None
+
+
+def write_missing_reports(table_list, songdata_db_path, out_dir, report_format='csv', jobs=None, immutable=False,
+                          log_settings=None):
+    """すべての難易度表について、未所持の譜面の一覧を out_dir に書き出す。
+
+    難易度表ごとの読み込み・マージ・書き出しは、jobs 個のプロセスで並列に行う。
+    songdata は読み込まず、各ワーカーが難易度表のハッシュを songdata.db に（読み取り専用で）問い合わせる。
+    immutable が真なら、songdata.db は変更されないものとして開く（songdata.SongDataDb）。
+    log_settings（instrument.configure の引数の dict）を指定すると、各ワーカーのログ・計測も同じように設定する。
+    trace_file はプロセスごとに {名前}.{PID}{拡張子} に書き出す。
+    難易度表ごとに (table_index, 出力ファイルのパス, 譜面数, 未所持数) または例外を返す
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(table_list, songdata_db_path, immutable, log_settings)) as executor:
+        futures = {}
+        for table_index, table in enumerate(table_list):
+            out_path = os.path.join(out_dir, _report_file_name(table_index, table, report_format))
+            futures[executor.submit(_write_table_report, table_index, out_path, report_format)] = table_index
+
+        for future in as_completed(futures):
+            table_index = futures[future]
+            try:
+                results[table_index] = future.result()
+                _, out_path, total, missing = results[table_index]
+                instrument.event(f'{table_list[table_index].get("name")}: 未所持 {missing}/{total} -> {out_path}')
+            except Exception as e:
+                results[table_index] = e
+                instrument.logger.warning(f'{table_list[table_index].get("name")}: {e}')
+
+    return [results[i] for i in range(len(table_list))]
+
+
+def _init_worker(table_list, songdata_db_path, immutable, log_settings):
+    if log_settings:
+        instrument.configure(**_worker_log_settings(log_settings))
+
+    # pandas などを読み込むのはワーカーだけ（GUI の起動時には読み込まない）
+    import bmstable
+    import songdata
+    from songindex import SqlSongIndex
+
+    global _worker_table
+    song_index = SqlSongIndex(songdata.open_songdata_db(songdata_db_path, immutable))
+    _worker_table = bmstable.BmsTable(table_list, None, song_index)
+
+
+def _worker_log_settings(log_settings):
+    # 複数のプロセスから同じトレースファイルに書くと壊れるので、プロセスごとに分ける
+    log_settings = dict(log_settings)
+    if log_settings.get('trace_file'):
+        root, ext = os.path.splitext(log_settings['trace_file'])
+        log_settings['trace_file'] = f'{root}.{os.getpid()}{ext}'
+    return log_settings
+
+
+def _write_table_report(table_index, out_path, report_format):
+    loaded = _worker_table.fetch(table_index)
+    df_missing = loaded.df_table[~loaded.df_table['found']]
+
+    level_symbol = loaded.table_header.get('symbol', '')
+    if report_format == 'csv':
+        _write_csv(df_missing, level_symbol, out_path)
+    else:
+        _write_json(df_missing, level_symbol, out_path)
+
+    return table_index, out_path, len(loaded.df_table), len(df_missing)
+
+
+def _report_rows(df, level_symbol):
+    """レポートの行（REPORT_COLUMNS の順の値）を 1 行ずつ返す"""
+    columns = [df[c] if c in df.columns else [''] * len(df) for c in REPORT_COLUMNS]
+    for values in zip(*columns):
+        row = ['' if _is_missing(v) else v for v in values]
+        row[0] = f'{level_symbol}{row[0]}'
+        yield row
+
+
+def _write_csv(df, level_symbol, out_path):
+    # Excel で開けるよう BOM 付きで書く
+    with open(out_path, 'wt', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_COLUMNS)
+        for row in _report_rows(df, level_symbol):
+            writer.writerow(row)
+
+
+def _write_json(df, level_symbol, out_path):
+    # 1 件ずつ書き出す（全件のリストは作らない）
+    with open(out_path, 'wt', encoding='utf-8') as f:
+        f.write('[')
+        for i, row in enumerate(_report_rows(df, level_symbol)):
+            f.write(',\n' if i > 0 else '\n')
+            json.dump(dict(zip(REPORT_COLUMNS, row)), f, ensure_ascii=False, default=str)
+        f.write('\n]\n')
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def _report_file_name(table_index, table, report_format):
+    name = re.sub(r'[\\/:*?"<>|\s]+', '_', table.get('name', ''))
+    return f'{table_index:02d}_{name}.{report_format}'
@@ -1,13 +1,423 @@
+import os
+import json
+import queue
 import sqlite3
+import pathlib
+import threading
+import numpy as np
 import pandas as pd
+from contextlib import contextmanager
 
-def read_songdata(songdata_db_path):
-    connection = sqlite3.connect(songdata_db_path)
-    connection.row_factory = sqlite3.Row
-    cursor = connection.cursor()
-    df = pd.read_sql_query(sql='SELECT md5,sha256,title,subtitle,artist,path FROM song', con=connection)
-    cursor.close()
-    connection.close()
+import colcache
+import instrument
 
-    df['title_inc_sub'] = df['title'].str.cat(df['subtitle'], sep=' ')
+SONGDATA_CACHE_DIR = 'cache/songdata/'
+SONGDATA_CACHE_VERSION = 4
+
+# ハッシュのバイト数。ハッシュは固定長のバイト列を 8 バイトずつ uint64 の列（md5_0, md5_1, ...）に分けて持つ
+# （空・不正なハッシュはすべて 0）
+HASH_BYTES = {'md5': 16, 'sha256': 32}
+HASH_COLUMNS = {key: [f'{key}_{i}' for i in range(nbytes // 8)] for key, nbytes in HASH_BYTES.items()}
+
+# 値の重複が多いので category 型で持つ列（格納パスはフォルダ dir と ファイル名 file に分ける）
+CATEGORY_COLUMNS = ['title', 'subtitle', 'artist', 'dir']
+
+# 難易度表とのマージ（SongIndex）に必要な列
+LOOKUP_COLUMNS = HASH_COLUMNS['md5'] + HASH_COLUMNS['sha256'] + ['dir', 'file']
+
+# 差分同期で行の同一性を判定する列（rowid はインデックス）
+SYNC_KEY_COLUMNS = ['path', 'md5', 'sha256']
+
+# rowid IN (...) に一度に渡す件数（SQLite の変数上限 999 未満）
+SQL_IN_CHUNK_SIZE = 500
+
+# songdata.db ごとに使い回す接続の数
+SONGDATA_DB_POOL_SIZE = 4
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+class SongDataDelta():
+    """差分同期で検出された song テーブルの追加行・削除行"""
+
+    def __init__(self, df_inserted, df_deleted):
+        self.df_inserted = df_inserted
+        self.df_deleted = df_deleted
+
+    def empty(self):
+        return len(self.df_inserted) == 0 and len(self.df_deleted) == 0
+
+    def changed_md5(self):
+        return _hash_set(hash_hex(self.df_inserted, 'md5')) | _hash_set(hash_hex(self.df_deleted, 'md5'))
+
+    def changed_sha256(self):
+        return _hash_set(hash_hex(self.df_inserted, 'sha256')) | _hash_set(hash_hex(self.df_deleted, 'sha256'))
+
+
+class SongDataDb():
+    """songdata.db への読み取り専用の接続
+
+    接続はプールしておき、スレッドをまたいで使い回す（同時に使うのは 1 スレッドずつ）。
+    immutable を真にすると SQLite はファイルの変更を確認しなくなる（beatoraja が songdata.db を
+    更新しないと分かっている場合だけ使うこと。更新されると誤った結果やエラーになる）
+    """
+
+    def __init__(self, songdata_db_path, immutable=False, pool_size=SONGDATA_DB_POOL_SIZE):
+        uri = pathlib.Path(os.path.abspath(songdata_db_path)).as_uri()
+        self.uri = f'{uri}?mode=ro&immutable=1' if immutable else f'{uri}?mode=ro'
+        self.pool = queue.LifoQueue()
+        self.pool_size = pool_size
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self.pool.get_nowait()
+        except queue.Empty:
+            connection = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+
+        try:
+            yield connection
+        finally:
+            if self.pool.qsize() < self.pool_size:
+                self.pool.put(connection)
+            else:
+                connection.close()
+
+    @contextmanager
+    def snapshot(self):
+        """ブロック内の問い合わせが、すべて同じ時点の内容を読むようにする（読み取りトランザクション）"""
+        with self.connection() as connection:
+            connection.execute('BEGIN')
+            try:
+                yield connection
+            finally:
+                connection.rollback()
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def lookup_hashes(self, key, hashes):
+        """key（'md5' または 'sha256'）のハッシュを持つ譜面を songdata.db から引く。
+
+        重複所持している場合は rowid が最小の行（読み込んだ songdata 上で先に現れる行）を使う。
+        見つかったハッシュ（小文字の 16 進文字列）をインデックスとし、列 rowid, path を持つ DataFrame を返す。
+        件数が少なければ IN (...) で、多ければ一時テーブルとの結合で問い合わせる。
+        songdata.db のハッシュは小文字で保存されているので、列をそのまま比較する（lower() を通すと列のインデックスが使えない）
+        """
+        if not key in HASH_BYTES:
+            raise ValueError(f'不明なハッシュの種類: {key}')
+
+        hashes = sorted({h.lower() for h in pd.Series(hashes, dtype=object).dropna()
+                         if isinstance(h, str) and len(h) == HASH_BYTES[key] * 2})
+
+        with self.connection() as connection:
+            if len(hashes) > SQL_IN_CHUNK_SIZE:
+                return self._lookup_hashes_temp_table(connection, key, hashes)
+            return self._lookup_hashes_in(connection, key, hashes)
+
+    def _lookup_hashes_in(self, connection, key, hashes):
+        # MIN(rowid) と同じ行の path が返る（SQLite の集約関数 min/max の仕様）
+        placeholders = ','.join('?' * len(hashes))
+        sql = (f'SELECT {key} AS hash, MIN(rowid) AS rowid, path FROM song '
+               f'WHERE {key} IN ({placeholders}) GROUP BY {key}')
+        return pd.read_sql_query(sql=sql, con=connection, params=hashes, index_col='hash')
+
+    def _lookup_hashes_temp_table(self, connection, key, hashes):
+        # 一時テーブルは接続ごとの temp データベースに作られるので、読み取り専用でも作成できる
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS lookup_hash (hash TEXT PRIMARY KEY)')
+        try:
+            connection.executemany('INSERT OR IGNORE INTO temp.lookup_hash VALUES (?)', ((h,) for h in hashes))
+            sql = (f'SELECT lookup_hash.hash AS hash, MIN(song.rowid) AS rowid, song.path FROM song '
+                   f'JOIN temp.lookup_hash ON song.{key} = lookup_hash.hash GROUP BY lookup_hash.hash')
+            return pd.read_sql_query(sql=sql, con=connection, index_col='hash')
+        finally:
+            connection.execute('DELETE FROM temp.lookup_hash')
+            connection.commit()
+
+    def search_titles(self, word, case_sensitive=False, limit=None):
+        """タイトル・サブタイトルに word を含む譜面を songdata.db から検索する。
+
+        songdata を読み込まずに検索できる。大文字・小文字の区別なしの場合は SQLite の LIKE による
+        （ASCII の英字のみ区別しない）。列 title, subtitle, artist, path を持つ DataFrame（インデックスは rowid）を返す
+        """
+        title = "(IFNULL(title, '') || ' ' || IFNULL(subtitle, ''))"
+        if case_sensitive:
+            condition, params = f'instr({title}, ?) > 0', [word]
+        else:
+            escaped = word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            condition, params = f"{title} LIKE ? ESCAPE '\\'", [f'%{escaped}%']
+
+        sql = f'SELECT rowid,title,subtitle,artist,path FROM song WHERE {condition} ORDER BY rowid'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        with self.connection() as connection:
+            return pd.read_sql_query(sql=sql, con=connection, params=params, index_col='rowid')
+
+
+def open_songdata_db(songdata_db_path, immutable=False):
+    """songdata.db の読み取り専用の接続（SongDataDb）を返す。同じパス・immutable には同じものを使い回す"""
+    key = (os.path.abspath(songdata_db_path), immutable)
+    with _databases_lock:
+        if not key in _databases:
+            _databases[key] = SongDataDb(songdata_db_path, immutable)
+        return _databases[key]
+
+
+def hash_bytes(df_songdata, key):
+    """key（'md5' または 'sha256'）のハッシュを固定長バイト列の配列（numpy の S16 / S32）で返す"""
+    words = np.ascontiguousarray(df_songdata[HASH_COLUMNS[key]].to_numpy(dtype=np.uint64))
+    return words.view(f'S{HASH_BYTES[key]}').ravel()
+
+
+def hash_hex(df_songdata, key):
+    """key のハッシュを 16 進文字列の配列で返す（空・不正なハッシュは ''）"""
+    return _bytes_to_hex(hash_bytes(df_songdata, key), HASH_BYTES[key])
+
+
+def hex_to_hash_bytes(values, key):
+    """16 進文字列のハッシュ（難易度表の md5 など）を固定長バイト列の配列に変換する。
+
+    空・不正な値は 0 のバイト列（b''）となる
+    """
+    nbytes = HASH_BYTES[key]
+    values = pd.Series(values, dtype=object)
+    valid = values.str.fullmatch(f'[0-9a-fA-F]{{{nbytes * 2}}}').fillna(False).to_numpy(dtype=bool)
+
+    hashes = np.zeros(len(values), dtype=f'S{nbytes}')
+    hashes[valid] = np.frombuffer(bytes.fromhex(''.join(values[valid])), dtype=f'S{nbytes}')
+    return hashes
+
+
+def song_paths(df_songdata):
+    """格納パスの配列を返す（dir と file から組み立てる）"""
+    return df_songdata['dir'].to_numpy(dtype=object) + df_songdata['file'].to_numpy(dtype=object)
+
+
+def title_inc_sub(df_songdata):
+    """タイトルとサブタイトルを連結した文字列の配列を返す"""
+    title = df_songdata['title'].to_numpy(dtype=object)
+    subtitle = df_songdata['subtitle'].to_numpy(dtype=object)
+    return np.where(pd.isna(title), '', title) + ' ' + np.where(pd.isna(subtitle), '', subtitle)
+
+
+def read_songdata(songdata_db_path, use_cache=True):
+    """songdata.db の譜面データを読み込む。
+
+    メモリ使用量を抑えるため、ハッシュは固定長のバイト列（HASH_COLUMNS）、
+    重複の多い文字列は category 型（CATEGORY_COLUMNS）で持つ。
+    格納パス・タイトル+サブタイトルは song_paths(), title_inc_sub() で組み立てる。
+
+    songdata.db（と WAL ファイル）の更新日時・サイズがキャッシュ作成時と変わっていなければ、
+    song テーブルを読まずにキャッシュ（cache/songdata/）から読み込む。
+    変わっていれば、キャッシュとの差分だけを読み込んで反映する
+    """
+    with instrument.span('read_songdata') as span:
+        stamp = _db_stamp(songdata_db_path)
+
+        if use_cache:
+            df, cached_stamp = _load_songdata_cache(stamp)
+            if df is not None and cached_stamp == stamp:
+                span.set(source='cache', rows=len(df))
+                return df
+
+            if df is not None:
+                df, _ = sync_songdata(songdata_db_path, df)
+                _save_songdata_cache(df, stamp)
+                span.set(source='delta', rows=len(df))
+                return df
+
+        df = _query_songdata(songdata_db_path)
+        _save_songdata_cache(df, stamp)
+        span.set(source='db', rows=len(df))
+        return df
+
+
+def reload_songdata(songdata_db_path, df_songdata):
+    """読み込み済みの songdata を songdata.db の現在の内容に更新し、キャッシュも書き換える。
+
+    (更新後の DataFrame, 差分（SongDataDelta）) を返す
+    """
+    with instrument.span('reload_songdata') as span:
+        stamp = _db_stamp(songdata_db_path)
+        df, delta = sync_songdata(songdata_db_path, df_songdata)
+        _save_songdata_cache(df, stamp)
+        span.set(rows=len(df))
+    return df, delta
+
+
+def sync_songdata(songdata_db_path, df_songdata):
+    """読み込み済みの songdata と songdata.db を比較し、差分だけを反映する。
+
+    song テーブルの rowid・path・ハッシュのみを読んで比較し、
+    追加された行だけを全列読み込む。
+    反映後の DataFrame と差分（SongDataDelta）を返す
+    """
+    with instrument.span('sync_songdata') as span:
+        df, delta = _sync_songdata(songdata_db_path, df_songdata)
+        span.set(inserted=len(delta.df_inserted), deleted=len(delta.df_deleted))
+    return df, delta
+
+
+def _sync_songdata(songdata_db_path, df_songdata):
+    with open_songdata_db(songdata_db_path).snapshot() as connection:
+        df_keys = pd.read_sql_query(sql='SELECT rowid,path,md5,sha256 FROM song', con=connection, index_col='rowid')
+
+        # 比較のため、songdata.db 側のハッシュも読み込み時と同じ変換を通して正規化する
+        df_keys = pd.DataFrame({
+            'path': df_keys['path'].fillna('').to_numpy(dtype=object),
+            'md5': _bytes_to_hex(hex_to_hash_bytes(df_keys['md5'], 'md5'), HASH_BYTES['md5']),
+            'sha256': _bytes_to_hex(hex_to_hash_bytes(df_keys['sha256'], 'sha256'), HASH_BYTES['sha256']),
+        }, index=df_keys.index)
+        df_loaded_keys = pd.DataFrame({
+            'path': song_paths(df_songdata),
+            'md5': hash_hex(df_songdata, 'md5'),
+            'sha256': hash_hex(df_songdata, 'sha256'),
+        }, index=df_songdata.index)
+
+        # rowid・path・ハッシュがすべて一致する行は変更なしとみなす
+        df_cmp = pd.merge(df_loaded_keys.reset_index(), df_keys.reset_index(),
+                          on=['rowid'] + SYNC_KEY_COLUMNS, how='outer', indicator=True)
+        deleted_rowids = df_cmp.loc[df_cmp['_merge'] == 'left_only', 'rowid']
+        inserted_rowids = df_cmp.loc[df_cmp['_merge'] == 'right_only', 'rowid']
+
+        df_inserted = _query_songdata_rows(connection, inserted_rowids.astype(int).tolist())
+
+    df_deleted = df_songdata.loc[deleted_rowids.astype(int)]
+    df = _categorize(pd.concat([df_songdata.drop(index=df_deleted.index), df_inserted]))
+
+    return df, SongDataDelta(df_inserted, df_deleted)
+
+
+def _query_songdata(songdata_db_path):
+    with open_songdata_db(songdata_db_path).connection() as connection:
+        df = pd.read_sql_query(sql='SELECT rowid,md5,sha256,title,subtitle,artist,path FROM song', con=connection, index_col='rowid')
+
+    return _compact(df)
+
+
+def _query_songdata_rows(connection, rowids):
+    """指定した rowid の行を読み込む"""
+    dfs = [_query_songdata_chunk(connection, [])]
+    for i in range(0, len(rowids), SQL_IN_CHUNK_SIZE):
+        dfs.append(_query_songdata_chunk(connection, rowids[i:i + SQL_IN_CHUNK_SIZE]))
+
+    return _compact(pd.concat(dfs))
+
+
+def _query_songdata_chunk(connection, rowids):
+    placeholders = ','.join('?' * len(rowids))
+    sql = f'SELECT rowid,md5,sha256,title,subtitle,artist,path FROM song WHERE rowid IN ({placeholders})'
+    return pd.read_sql_query(sql=sql, con=connection, params=rowids, index_col='rowid')
+
+
+def _compact(df):
+    """song テーブルから読み込んだ DataFrame をメモリ使用量の少ない形式に変換する"""
+    df_compact = pd.DataFrame(index=df.index)
+    for key, columns in HASH_COLUMNS.items():
+        words = hex_to_hash_bytes(df[key], key).view(np.uint64).reshape(-1, len(columns))
+        for i, column in enumerate(columns):
+            df_compact[column] = words[:, i]
+
+    df_compact['title'] = df['title']
+    df_compact['subtitle'] = df['subtitle']
+    df_compact['artist'] = df['artist']
+
+    # 格納パスを最後の区切り文字（/ または \）の位置でフォルダとファイル名に分ける
+    path = df['path'].fillna('').tolist()
+    split_at = [max(p.rfind('/'), p.rfind('\\')) + 1 for p in path]
+    df_compact['dir'] = pd.Series([p[:i] for p, i in zip(path, split_at)], index=df.index, dtype=object)
+    df_compact['file'] = pd.Series([p[i:] for p, i in zip(path, split_at)], index=df.index, dtype=object)
+
+    return _categorize(df_compact)
+
+
+def _categorize(df):
+    # concat などで category 型でなくなった列も戻す
+    for column in CATEGORY_COLUMNS:
+        if not isinstance(df[column].dtype, pd.CategoricalDtype):
+            codes, categories = pd.factorize(df[column].to_numpy(dtype=object))
+            df[column] = pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object))
     return df
+
+
+def _bytes_to_hex(hashes, nbytes):
+    """固定長バイト列の配列を 16 進文字列の配列にする（0 のバイト列は ''）"""
+    text = np.ascontiguousarray(hashes).tobytes().hex()
+    width = nbytes * 2
+    empty = '0' * width
+    values = np.empty(len(hashes), dtype=object)
+    values[:] = [text[i:i + width] for i in range(0, len(text), width)]
+    values[values == empty] = ''
+    return values
+
+
+def _hash_set(values):
+    return set(values) - {''}
+
+
+def _db_stamp(songdata_db_path):
+    """キャッシュの有効性判定に使う songdata.db の識別情報
+
+    コミットが本体に反映されず WAL ファイル（{path}-wal）にだけ書かれることがあるので、
+    tkworker.FileWatcher と同じく WAL ファイルの更新日時・サイズも含める（なければ None）
+    """
+    st = os.stat(songdata_db_path)
+    try:
+        st_wal = os.stat(f'{songdata_db_path}-wal')
+        wal_mtime, wal_size = st_wal.st_mtime_ns, st_wal.st_size
+    except OSError:
+        wal_mtime, wal_size = None, None
+
+    return {
+        'version': SONGDATA_CACHE_VERSION,
+        'db_path': os.path.abspath(songdata_db_path),
+        'mtime': st.st_mtime_ns,
+        'size': st.st_size,
+        'wal_mtime': wal_mtime,
+        'wal_size': wal_size,
+    }
+
+
+def _same_db(cached_stamp, stamp):
+    """同じ songdata.db から同じ形式で作られたキャッシュか（差分同期できるか）"""
+    return all(cached_stamp.get(key) == stamp[key] for key in ['version', 'db_path'])
+
+
+def _load_songdata_cache(stamp):
+    meta_path = f'{SONGDATA_CACHE_DIR}meta.json'
+    df_dir = f'{SONGDATA_CACHE_DIR}songdata/'
+    if not (os.path.isfile(meta_path) and colcache.is_valid(df_dir)):
+        return None, None
+
+    with open(meta_path) as f:
+        cached_stamp = json.load(f)
+
+    if not _same_db(cached_stamp, stamp):
+        return None, None
+
+    # 別のプロセスが保存している最中なら None（キャッシュなし）
+    df = colcache.load_frame(df_dir)
+    if df is None:
+        return None, None
+    return df, cached_stamp
+
+
+def _save_songdata_cache(df, stamp):
+    os.makedirs(SONGDATA_CACHE_DIR, exist_ok=True)
+
+    # meta.json は最後に書く（途中で失敗した場合はキャッシュ無効として扱われる）
+    meta_path = f'{SONGDATA_CACHE_DIR}meta.json'
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+
+    colcache.save_frame(df, f'{SONGDATA_CACHE_DIR}songdata/')
+
+    with open(meta_path, 'wt') as f:
+        json.dump(stamp, f)
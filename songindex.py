@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+import songdata
+
+
+class SongIndex():
+    """songdata のハッシュ（md5, sha256）から格納パスを引くための索引
+
+    songdata の読み込みごとに一度だけ作成し、すべての難易度表のマージで使い回す
+    """
+
+    def __init__(self, df_songdata):
+        self.md5_keys, self.md5_rows = _build_lookup(df_songdata, 'md5')
+        self.sha256_keys, self.sha256_rows = _build_lookup(df_songdata, 'sha256')
+
+        # 格納パスは見つかった行の分だけ組み立てる
+        self.dir_codes = df_songdata['dir'].cat.codes.to_numpy()
+        self.dir_names = df_songdata['dir'].cat.categories.to_numpy(dtype=object)
+        self.files = df_songdata['file'].to_numpy(dtype=object)
+
+    def find(self, md5, sha256):
+        """難易度表の各行（md5, sha256 の列）に対応する songdata の行位置の配列を返す。
+
+        md5 で見つかればその行、見つからなければ sha256 で見つかった行、
+        どちらでも見つからなければ -1 となる
+        """
+        rows = _lookup(self.md5_keys, self.md5_rows, songdata.hex_to_hash_bytes(md5, 'md5'))
+        rows_sha256 = _lookup(self.sha256_keys, self.sha256_rows, songdata.hex_to_hash_bytes(sha256, 'sha256'))
+        return np.where(rows >= 0, rows, rows_sha256)
+
+    def resolve(self, md5, sha256):
+        """難易度表の各行（md5, sha256 の列）に対応する格納パスの配列を返す（見つからなければ ''）"""
+        rows = self.find(md5, sha256)
+
+        paths = np.full(len(rows), '', dtype=object)
+        found = rows >= 0
+        paths[found] = self.dir_names[self.dir_codes[rows[found]]] + self.files[rows[found]]
+        return paths
+
+
+def _build_lookup(df_songdata, key):
+    """ハッシュ（昇順）と、それを持つ songdata の行位置の配列を作る
+
+    重複所持している場合は songdata 上で先に現れる行を使う
+    """
+    hashes = songdata.hash_bytes(df_songdata, key)
+    rows = np.flatnonzero(hashes != b'')
+    keys, first = np.unique(hashes[rows], return_index=True)
+    return keys, rows[first]
+
+
+def _lookup(keys, rows, values):
+    # 見つからない値（空のハッシュを含む）は -1
+    if len(keys) == 0:
+        return np.full(len(values), -1, dtype=np.int64)
+
+    positions = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+    hit = (keys[positions] == values) & (values != b'')
+    return np.where(hit, rows[positions], -1)
+
+
+class SqlSongIndex():
+    """songdata を読み込まずに、songdata.db に問い合わせてハッシュを引く索引（SongIndex と同じ使い方）
+
+    難易度表の譜面数が songdata よりずっと少ない場合（レポートの書き出しなど）に使う。
+    find() が返すのは行位置ではなく songdata.db の rowid
+    """
+
+    def __init__(self, songdata_db):
+        self.songdata_db = songdata_db
+
+    def find(self, md5, sha256):
+        """難易度表の各行に対応する songdata.db の rowid の配列を返す（見つからなければ -1）"""
+        rows, _ = self._find(md5, sha256)
+        return rows
+
+    def resolve(self, md5, sha256):
+        """難易度表の各行（md5, sha256 の列）に対応する格納パスの配列を返す（見つからなければ ''）"""
+        _, paths = self._find(md5, sha256)
+        return paths
+
+    def _find(self, md5, sha256):
+        md5 = pd.Series(md5, dtype=object).fillna('').str.lower().to_numpy()
+        sha256 = pd.Series(sha256, dtype=object).fillna('').str.lower().to_numpy()
+        rows = np.full(len(md5), -1, dtype=np.int64)
+        paths = np.full(len(md5), '', dtype=object)
+
+        # md5 で見つからなかった行だけ sha256 で引く
+        for key, hashes in (('md5', md5), ('sha256', sha256)):
+            missing = rows < 0
+            df_found = self.songdata_db.lookup_hashes(key, hashes[missing])
+            positions = df_found.index.get_indexer(hashes[missing])
+            hit = positions >= 0
+            targets = np.flatnonzero(missing)[hit]
+            rows[targets] = df_found['rowid'].to_numpy()[positions[hit]]
+            paths[targets] = df_found['path'].to_numpy(dtype=object)[positions[hit]]
+
+        return rows, paths
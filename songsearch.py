@@ -0,0 +1,159 @@
+import re
+import functools
+import numpy as np
+
+import songdata
+
+
+# 検索をキャンセルしたか確認する間隔（確認する行数・見つかった位置の数）
+CANCEL_CHECK_ROWS = 4096
+
+
+class SearchCancelled(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=64)
+def _compile(pattern, flags):
+    return re.compile(pattern, flags)
+
+
+class SongSearchIndex():
+    """songdata のタイトル（タイトル+サブタイトル）を検索するための索引
+
+    songdata の読み込みごとに一度だけ作成する。
+
+    - すべてのタイトルを改行で区切って連結した文字列（casefold したものも）
+    - casefold したタイトルの 3-gram → 行番号 の転置索引
+
+    3 文字以上の部分一致検索は転置索引で候補を絞ってから確認する。
+    2 文字以下の場合は連結した文字列をまとめて走査して探す
+    """
+    SEPARATOR = '\n'
+    NGRAM = 3
+
+    def __init__(self, df_songdata):
+        titles = [title.replace(self.SEPARATOR, ' ') for title in songdata.title_inc_sub(df_songdata)]
+        titles_folded = [title.casefold() for title in titles]
+
+        self.titles = titles
+        self.titles_folded = titles_folded
+        self.corpus, self.starts = self._join(titles)
+        self.corpus_folded, self.starts_folded = self._join(titles_folded)
+        self.gram_keys, self.gram_offsets, self.gram_rows = self._build_ngram_index(self.corpus_folded, self.starts_folded)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def search(self, word, use_re=False, case_sensitive=False, candidates=None, cancel_event=None):
+        """タイトルに word を含む行の番号（songdata 上の位置）を昇順の配列で返す。
+
+        candidates（行番号の昇順の配列）を指定すると、その中だけを検索する。
+        正規表現が不正な場合は re.error を、cancel_event がセットされたら SearchCancelled を送出する
+        """
+        if use_re:
+            flags = 0 if case_sensitive else re.IGNORECASE
+            rx = _compile(word, flags)
+            rows = range(len(self.titles)) if candidates is None else candidates
+            return self._filter(rows, lambda i: rx.search(self.titles[i]), cancel_event)
+
+        if word == '':
+            return np.arange(len(self.titles)) if candidates is None else np.asarray(candidates, dtype=np.int64)
+
+        word_folded = word.casefold()
+
+        if candidates is None and len(word_folded) >= self.NGRAM:
+            candidates = self._ngram_candidates(word_folded, cancel_event)
+
+        if candidates is None:
+            if case_sensitive:
+                return self._find_all(self.corpus, self.starts, word, cancel_event)
+            return self._find_all(self.corpus_folded, self.starts_folded, word_folded, cancel_event)
+
+        if case_sensitive:
+            return self._filter(candidates, lambda i: word in self.titles[i], cancel_event)
+        return self._filter(candidates, lambda i: word_folded in self.titles_folded[i], cancel_event)
+
+    def _filter(self, rows, predicate, cancel_event):
+        """rows のうち predicate を満たす行を返す。CANCEL_CHECK_ROWS 行ごとにキャンセルを確認する"""
+        found = []
+        for start in range(0, len(rows), CANCEL_CHECK_ROWS):
+            _check_cancelled(cancel_event)
+            found.extend(i for i in rows[start:start + CANCEL_CHECK_ROWS] if predicate(i))
+        return np.array(found, dtype=np.int64)
+
+    def _join(self, titles):
+        corpus = self.SEPARATOR.join(titles) + self.SEPARATOR
+        lengths = np.fromiter((len(title) + 1 for title in titles), dtype=np.int64, count=len(titles))
+        starts = np.concatenate([[0], np.cumsum(lengths)])
+        return corpus, starts
+
+    def _ngram_keys(self, codes):
+        # コードポイントは 21 ビットに収まるので、3 文字を 1 つの int64 にまとめる
+        return (codes[:-2] << 42) | (codes[1:-1] << 21) | codes[2:]
+
+    def _build_ngram_index(self, corpus, starts):
+        """3-gram の転置索引を作る
+
+        gram_keys（昇順）の i 番目の 3-gram を含む行は gram_rows[gram_offsets[i]:gram_offsets[i + 1]]（昇順）
+        """
+        codes = np.frombuffer(corpus.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        rows = np.repeat(np.arange(len(starts) - 1, dtype=np.int32), np.diff(starts))
+
+        keys = self._ngram_keys(codes)
+        rows = rows[:-2]
+
+        # 区切り文字をまたぐ 3-gram は除く
+        sep = ord(self.SEPARATOR)
+        valid = (codes[:-2] != sep) & (codes[1:-1] != sep) & (codes[2:] != sep)
+        keys, rows = keys[valid], rows[valid]
+
+        # 3-gram ごとに行番号の昇順に並べ（行番号はもともと昇順なので安定ソート）、同じ行の重複を除く
+        order = np.argsort(keys, kind='stable')
+        keys, rows = keys[order], rows[order]
+        keep = np.ones(len(keys), dtype=bool)
+        keep[1:] = (keys[1:] != keys[:-1]) | (rows[1:] != rows[:-1])
+        keys, rows = keys[keep], rows[keep]
+
+        gram_keys, gram_starts = np.unique(keys, return_index=True)
+        gram_offsets = np.append(gram_starts, len(keys))
+        return gram_keys, gram_offsets, rows
+
+    def _ngram_candidates(self, word_folded, cancel_event=None):
+        """word_folded のすべての 3-gram を含む行（word_folded を含む可能性のある行）を返す"""
+        codes = np.array([ord(c) for c in word_folded], dtype=np.int64)
+        keys = np.unique(self._ngram_keys(codes))
+
+        if len(self.gram_keys) == 0:
+            return np.array([], dtype=np.int64)
+
+        positions = np.searchsorted(self.gram_keys, keys)
+        positions = np.minimum(positions, len(self.gram_keys) - 1)
+        if not (self.gram_keys[positions] == keys).all():
+            return np.array([], dtype=np.int64)
+
+        postings = [self.gram_rows[self.gram_offsets[p]:self.gram_offsets[p + 1]] for p in positions]
+        postings.sort(key=len)
+        candidates = postings[0]
+        for posting in postings[1:]:
+            _check_cancelled(cancel_event)
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+            if len(candidates) == 0:
+                break
+        return candidates
+
+    def _find_all(self, corpus, starts, word, cancel_event=None):
+        # 区切り文字をまたいで一致することはないので、見つかった位置から行番号がそのまま求まる
+        positions = []
+        for m in re.finditer(re.escape(word), corpus):
+            if len(positions) % CANCEL_CHECK_ROWS == 0:
+                _check_cancelled(cancel_event)
+            positions.append(m.start())
+        positions = np.array(positions, dtype=np.int64)
+        rows = np.searchsorted(starts, positions, side='right') - 1
+        return np.unique(rows)
+
+
+def _check_cancelled(cancel_event):
+    if cancel_event and cancel_event.is_set():
+        raise SearchCancelled()
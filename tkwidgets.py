@@ -20,6 +20,12 @@ class ClickableLabel():
         if url:
             self.label.bind('<Button-1>', lambda e: self._link_click(url))
 
+    def set_click_command(self, command):
+        """クリックされたら command() を呼ぶ（URL を開く代わりに）"""
+        self.label.unbind('<Button-1>')
+        if command:
+            self.label.bind('<Button-1>', lambda e: command())
+
     def _link_click(self, url):
         webbrowser.open_new(url)
 
@@ -48,6 +54,10 @@ class TextBox():
     def get_text(self):
         return self.text.get()
 
+    def set_change_event(self, callback):
+        """テキストが変更されるたびに callback() を呼ぶ"""
+        self.text.trace_add('write', lambda *args: callback())
+
     def _on_cut(self):
         self.entry.event_generate('<<Cut>>')
 
@@ -0,0 +1,148 @@
+import os
+import queue
+import threading
+
+
+class BackgroundTask():
+    """Tk のメインループを止めずに、処理を別スレッドで実行する。
+
+    func は (progress, cancel_event) を引数に取る関数で、別スレッドで実行される。
+    進捗・結果・例外はキューを経由し、after() によりメインスレッドで
+    on_progress, on_done, on_error に渡される。
+    cancel() された後は、どのコールバックも呼ばれない
+    """
+    POLL_INTERVAL_MS = 50
+
+    def __init__(self, root, func, on_done, on_error=None, on_progress=None):
+        self.root = root
+        self.func = func
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.cancel_event = threading.Event()
+        self.queue = queue.Queue()
+        self.finished = False
+
+    def start(self):
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        self.root.after(self.POLL_INTERVAL_MS, self._poll)
+        return self
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def running(self):
+        return not self.finished
+
+    def _run(self):
+        try:
+            result = self.func(self._report_progress, self.cancel_event)
+            self.queue.put(('done', result))
+        except Exception as e:
+            self.queue.put(('error', e))
+
+    def _report_progress(self, message):
+        self.queue.put(('progress', message))
+
+    def _poll(self):
+        while True:
+            try:
+                kind, value = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind != 'progress':
+                self.finished = True
+
+            if self.cancelled():
+                continue
+
+            if kind == 'progress' and self.on_progress:
+                self.on_progress(value)
+            elif kind == 'done':
+                self.on_done(value)
+            elif kind == 'error' and self.on_error:
+                self.on_error(value)
+
+        if not self.finished:
+            self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
+
+class Debouncer():
+    """trigger() が呼ばれなくなってから delay_ms 経過したときに、func を一度だけ実行する"""
+
+    def __init__(self, root, delay_ms, func):
+        self.root = root
+        self.delay_ms = delay_ms
+        self.func = func
+        self.after_id = None
+
+    def trigger(self):
+        self.cancel()
+        self.after_id = self.root.after(self.delay_ms, self._run)
+
+    def cancel(self):
+        if self.after_id:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+    def _run(self):
+        self.after_id = None
+        self.func()
+
+
+class FileWatcher():
+    """ファイルの更新日時・サイズを interval_ms ごとに確認し、変わったら on_change を呼ぶ。
+
+    OS 固有の API は使わず、after() によりメインスレッドでポーリングする。
+    書き込み中に反応しないよう、変わった後の状態が一度の確認の間変化しなかったときに呼ぶ。
+    SQLite の WAL ファイル（{path}-wal）があれば、その変化も対象とする
+    """
+
+    def __init__(self, root, path, interval_ms, on_change):
+        self.root = root
+        self.path = path
+        self.interval_ms = interval_ms
+        self.on_change = on_change
+        self.after_id = None
+        self.state = self._stat()
+        self.pending_state = None
+
+    def start(self):
+        self.after_id = self.root.after(self.interval_ms, self._poll)
+        return self
+
+    def stop(self):
+        if self.after_id:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+    def _stat(self):
+        state = []
+        for path in [self.path, f'{self.path}-wal']:
+            try:
+                st = os.stat(path)
+                state.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                state.append(None)
+
+        # 本体を一時的に読めない（置き換え中など）場合は変化なしとして扱う
+        return tuple(state) if state[0] else None
+
+    def _poll(self):
+        state = self._stat()
+        if state is None or state == self.state:
+            self.pending_state = None
+        elif state != self.pending_state:
+            # 変化を検出。次の確認まで変化が続かなければ通知する
+            self.pending_state = state
+        else:
+            self.state = state
+            self.pending_state = None
+            self.on_change()
+
+        self.after_id = self.root.after(self.interval_ms, self._poll)